@@ -3,16 +3,18 @@ from flask_sqlalchemy import SQLAlchemy
 from dotenv import load_dotenv
 import os
 
+from app.session import ShardedSession
+
 # Load environment variables from .env file
 load_dotenv()
 
 # Create an instance of the SQLAlchemy class
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': ShardedSession})
 
 # Function to create and configure the Flask app
 
 
-def create_app(testing=False):
+def create_app(testing=False, config=None):
     app = Flask(__name__)
 
     # Configure app with environment variables
@@ -25,12 +27,79 @@ def create_app(testing=False):
     else:
         app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL')
 
+    # Optional shard databases, as a comma separated list of URLs
+    app.config['SHARD_DATABASE_URLS'] = [
+        url for url in os.environ.get('SHARD_DATABASE_URLS', '').split(',') if url
+    ]
+
+    # Directory shared by all worker processes for metric files
+    app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+
+    # Per-request sampling profiler, see app.profiling
+    app.config['PROFILING_ENABLED'] = bool(os.environ.get('PROFILING_ENABLED'))
+    app.config['PROFILE_SAMPLE_RATE'] = float(
+        os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    threshold = os.environ.get('PROFILE_LATENCY_THRESHOLD')
+    app.config['PROFILE_LATENCY_THRESHOLD'] = float(
+        threshold) if threshold else None
+
+    # Load shedding in front of the blueprints, see app.admission
+    app.config['ADMISSION_ENABLED'] = bool(os.environ.get('ADMISSION_ENABLED'))
+
+    # Country code assumed for phone numbers without one
+    app.config['PHONE_COUNTRY_CODE'] = os.environ.get('PHONE_COUNTRY_CODE', '1')
+
+    # Explicit overrides, mostly used by tests
+    app.config.update(config or {})
+
     # Initialize the database with the app
     db.init_app(app)
 
+    # Report startup time, see app.preload
+    from app import preload
+    preload.init_app(app)
+
+    # Record per-endpoint request metrics, exposed at /metrics
+    from app import metrics
+    metrics.init_app(app)
+
+    # Compress responses negotiated through Accept-Encoding. Registered after
+    # metrics so the recorded response size is the size on the wire.
+    from app import compression
+    compression.init_app(app)
+
+    # Reject requests early when overloaded
+    from app import admission
+    admission.init_app(app)
+
+    # Profile requests on demand when enabled
+    from app import profiling
+    profiling.init_app(app)
+
+    # Set up shard engines and routing for shop-scoped requests
+    from app import sharding
+    sharding.init_app(app)
+
+    # Replay responses of retried create requests
+    from app import idempotency
+    idempotency.init_app(app)
+
     # Import and register blueprints for routes
     from app.routes import shop, user
     app.register_blueprint(shop.bp)
     app.register_blueprint(user.bp)
 
+    # Register CLI commands
+    from app.archive import archive_deleted_command
+    app.cli.add_command(archive_deleted_command)
+    from app.lookup import backfill_lookup_columns_command
+    app.cli.add_command(backfill_lookup_columns_command)
+    from app.migrations import (add_version_columns_command,
+                                add_archive_indexes_command)
+    app.cli.add_command(add_version_columns_command)
+    app.cli.add_command(add_archive_indexes_command)
+    app.cli.add_command(sharding.create_shards_command)
+    app.cli.add_command(sharding.register_shops_command)
+    app.cli.add_command(sharding.move_shop_command)
+
     return app
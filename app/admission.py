@@ -0,0 +1,324 @@
+import fcntl
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+
+from app.serializers import render
+
+# Admission control in front of the shop and user blueprints. Requests are
+# split into route classes, each with a token bucket (429 when empty), a
+# CoDel check on the queueing delay reported by the proxy in X-Request-Start
+# (503 when it stays above target for an interval) and an AIMD concurrency
+# limit (503 when full). The state of every class lives in a memory-mapped
+# file so all gunicorn workers share the same buckets and limits.
+
+DEFAULT_ADMISSION_DIR = os.path.join(tempfile.gettempdir(),
+                                     'every_backend_admission')
+
+ROUTE_CLASSES = ('read', 'write', 'bulk')
+
+# Endpoints returning whole tables are admitted as bulk requests
+BULK_ENDPOINTS = {
+    'shop.get_shops', 'shop.list_products', 'shop.list_categories',
+    'user.get_users',
+}
+
+DEFAULT_SETTINGS = {
+    'read': {'initial_limit': 64, 'min_limit': 4, 'max_limit': 256,
+             'target_latency': 0.25, 'rate': None, 'burst': None},
+    'write': {'initial_limit': 16, 'min_limit': 2, 'max_limit': 64,
+              'target_latency': 0.5, 'rate': None, 'burst': None},
+    'bulk': {'initial_limit': 4, 'min_limit': 1, 'max_limit': 16,
+             'target_latency': 1.0, 'rate': None, 'burst': None},
+}
+
+# CoDel defaults: shed once the queueing delay stays above target for interval
+QUEUE_TARGET = 0.005
+QUEUE_INTERVAL = 0.1
+
+# Multiplicative decrease applied to the limit when a request is too slow
+BACKOFF = 0.9
+
+# Worker processes tracked in the shared file, and how often each worker
+# checks for dead ones whose in-flight requests never finished
+MAX_WORKERS = 256
+REAP_INTERVAL = 1.0
+
+# Fields stored per route class
+(INFLIGHT, LIMIT, TOKENS, REFILLED_AT, FIRST_ABOVE_AT,
+ BACKED_OFF_AT) = range(6)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Fixed-size records of doubles, one per route class, in a memory-mapped
+# file, followed by one record per worker holding its pid and its share of
+# each class's in-flight count. Access is serialized by a thread lock plus
+# flock across processes.
+
+
+class SharedState:
+    _RECORD = struct.Struct('6d')
+
+    def __init__(self, path, size, workers=MAX_WORKERS):
+        self._size = size
+        self._workers = workers
+        self._worker_record = struct.Struct(f'{size + 1}d')
+        self._file = open(path, 'a+b')
+        length = (size * self._RECORD.size
+                  + workers * self._worker_record.size)
+        if os.fstat(self._file.fileno()).st_size < length:
+            self._file.truncate(length)
+        self._mmap = mmap.mmap(self._file.fileno(), length)
+        self._lock = threading.Lock()
+        self._slot = None
+
+    @contextmanager
+    def _file_locked(self):
+        with self._lock:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    # In-flight changes made in the block are also recorded against the
+    # calling process, so reap() can give them back if it dies
+    @contextmanager
+    def locked(self, index):
+        offset = index * self._RECORD.size
+        with self._file_locked():
+            values = list(self._RECORD.unpack_from(self._mmap, offset))
+            inflight = values[INFLIGHT]
+            yield values
+            self._RECORD.pack_into(self._mmap, offset, *values)
+            if values[INFLIGHT] != inflight:
+                self._track(index, values[INFLIGHT] - inflight)
+
+    def _worker_offset(self, slot):
+        return (self._size * self._RECORD.size
+                + slot * self._worker_record.size)
+
+    def _read_worker(self, slot):
+        return list(self._worker_record.unpack_from(
+            self._mmap, self._worker_offset(slot)))
+
+    def _write_worker(self, slot, values):
+        self._worker_record.pack_into(
+            self._mmap, self._worker_offset(slot), *values)
+
+    # Give back the in-flight counts of a worker record and clear it
+    def _forget(self, slot, worker):
+        for index in range(self._size):
+            offset = index * self._RECORD.size
+            values = list(self._RECORD.unpack_from(self._mmap, offset))
+            values[INFLIGHT] = max(0, values[INFLIGHT] - worker[index + 1])
+            self._RECORD.pack_into(self._mmap, offset, *values)
+        self._write_worker(slot, [0] * (self._size + 1))
+
+    # Find this process's worker record, claiming a free one on first use. A
+    # record already holding our pid belongs to a dead process that had the
+    # same pid, so its counts are given back first.
+    def _own_slot(self):
+        pid = os.getpid()
+        if self._slot is not None and self._slot[0] == pid:
+            return self._slot[1]
+
+        free = None
+        for slot in range(self._workers):
+            worker = self._read_worker(slot)
+            if worker[0] == pid:
+                self._forget(slot, worker)
+                free = slot
+                break
+            if not worker[0] and free is None:
+                free = slot
+        if free is None:
+            return None
+        self._write_worker(free, [pid] + [0] * self._size)
+        self._slot = (pid, free)
+        return free
+
+    def _track(self, index, delta):
+        slot = self._own_slot()
+        if slot is None:
+            return
+        worker = self._read_worker(slot)
+        worker[index + 1] += delta
+        self._write_worker(slot, worker)
+
+    # Give back the in-flight counts of workers that died, e.g. killed on
+    # timeout or restarted by max_requests, with requests still running
+    def reap(self):
+        reaped = 0
+        with self._file_locked():
+            for slot in range(self._workers):
+                worker = self._read_worker(slot)
+                pid = int(worker[0])
+                if pid and pid != os.getpid() and not _is_alive(pid):
+                    self._forget(slot, worker)
+                    reaped += 1
+        return reaped
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+# Try to admit a request. Returns None when admitted, or the status code and
+# Retry-After seconds to reject it with.
+def admit(state, index, settings, queue_delay, now):
+    with state.locked(index) as values:
+        if not values[LIMIT]:
+            values[LIMIT] = settings['initial_limit']
+            values[TOKENS] = settings['burst'] or 0
+            values[REFILLED_AT] = now
+
+        rate = settings['rate']
+        if rate:
+            values[TOKENS] = min(settings['burst'], values[TOKENS]
+                                 + (now - values[REFILLED_AT]) * rate)
+            values[REFILLED_AT] = now
+            if values[TOKENS] < 1:
+                return 429, math.ceil((1 - values[TOKENS]) / rate)
+
+        if queue_delay is not None:
+            if queue_delay < settings['queue_target']:
+                values[FIRST_ABOVE_AT] = 0
+            elif not values[FIRST_ABOVE_AT]:
+                values[FIRST_ABOVE_AT] = now + settings['queue_interval']
+            elif now >= values[FIRST_ABOVE_AT]:
+                return 503, 1
+
+        if values[INFLIGHT] >= int(values[LIMIT]):
+            return 503, 1
+
+        if rate:
+            values[TOKENS] -= 1
+        values[INFLIGHT] += 1
+        return None
+
+
+# Release an admitted request and adapt the limit to its latency
+def release(state, index, settings, latency, now):
+    with state.locked(index) as values:
+        values[INFLIGHT] = max(0, values[INFLIGHT] - 1)
+        if latency > settings['target_latency']:
+            # Back off once per window: requests admitted before the last
+            # decrease saw the old limit and are not counted again
+            if now - latency >= values[BACKED_OFF_AT]:
+                values[LIMIT] = max(settings['min_limit'],
+                                    values[LIMIT] * BACKOFF)
+                values[BACKED_OFF_AT] = now
+        else:
+            values[LIMIT] = min(settings['max_limit'],
+                                values[LIMIT] + 1 / values[LIMIT])
+
+
+def route_class(endpoint, method):
+    if endpoint in BULK_ENDPOINTS:
+        return 'bulk'
+    if method in ('GET', 'HEAD'):
+        return 'read'
+    return 'write'
+
+
+# Queueing delay from an X-Request-Start: t=<unix seconds> proxy header
+def _queue_delay(now):
+    header = request.headers.get('X-Request-Start', '')
+    if not header.startswith('t='):
+        return None
+    try:
+        return max(0.0, now - float(header[2:]))
+    except ValueError:
+        return None
+
+
+# State is opened lazily so every forked worker maps the file itself
+_states = {}
+
+
+def _state(app, now):
+    path = app.config['ADMISSION_STATE_FILE']
+    pid = os.getpid()
+    state = _states.get(path)
+    if state is None or state[0] != pid:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        state = [pid, SharedState(path, len(ROUTE_CLASSES)), 0]
+        _states[path] = state
+    if now - state[2] >= REAP_INTERVAL:
+        state[2] = now
+        state[1].reap()
+    return state[1]
+
+
+def _before_request():
+    if request.blueprint not in ('shop', 'user'):
+        return None
+
+    app = current_app._get_current_object()
+    name = route_class(request.endpoint, request.method)
+    settings = app.extensions['admission'][name]
+    now = time.time()
+    rejection = admit(_state(app, now), ROUTE_CLASSES.index(name), settings,
+                      _queue_delay(now), now)
+    if rejection is not None:
+        status, retry_after = rejection
+        message = ("Too many requests" if status == 429
+                   else "Server overloaded, try again shortly")
+        return (render({"error": message}), status,
+                {"Retry-After": str(retry_after)})
+
+    g.admission = (name, now)
+    return None
+
+
+def _teardown_request(exc):
+    admitted = g.pop('admission', None)
+    if admitted is None:
+        return
+
+    app = current_app._get_current_object()
+    name, start = admitted
+    now = time.time()
+    release(_state(app, now), ROUTE_CLASSES.index(name),
+            app.extensions['admission'][name], now - start, now)
+
+
+# Register admission control when ADMISSION_ENABLED is set. ADMISSION_LIMITS
+# overrides DEFAULT_SETTINGS per route class.
+def init_app(app):
+    if not app.config.get('ADMISSION_ENABLED'):
+        return
+
+    app.config.setdefault('ADMISSION_STATE_FILE', os.path.join(
+        DEFAULT_ADMISSION_DIR, 'admission.db'))
+    overrides = app.config.get('ADMISSION_LIMITS') or {}
+    app.extensions['admission'] = {
+        name: {'queue_target': QUEUE_TARGET, 'queue_interval': QUEUE_INTERVAL,
+               **DEFAULT_SETTINGS[name], **overrides.get(name, {})}
+        for name in ROUTE_CLASSES
+    }
+
+    # A rate without a burst allows one second worth of requests at once
+    for settings in app.extensions['admission'].values():
+        if settings['rate'] and settings['burst'] is None:
+            settings['burst'] = max(1, settings['rate'])
+
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
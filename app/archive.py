@@ -0,0 +1,106 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import delete, insert, select
+
+from app import db, sharding
+from app.models import (Shop, ShopHours, Product, User, UserRole,
+                        ShopArchive, ShopHoursArchive, ProductArchive,
+                        UserArchive, UserRoleArchive)
+
+# Number of parent rows, and of child rows, moved per transaction. Each
+# batch commits on its own so no lock on the hot tables is held longer than
+# one batch takes. Children are found through their indexed parent columns.
+DEFAULT_BATCH_SIZE = 500
+
+
+# Copy the rows matching criteria into the archive table, then delete them
+def _move_rows(model, archive_model, criteria):
+    columns = [column.name for column in model.__table__.columns]
+    db.session.execute(
+        insert(archive_model).from_select(
+            columns, select(*model.__table__.columns).where(criteria))
+    )
+    db.session.execute(
+        delete(model).where(criteria).execution_options(
+            synchronize_session=False)
+    )
+
+
+# Move the children of the given parents in batches of at most batch_size
+# rows. The parents stay soft-deleted in the hot table until their children
+# are gone, so an interrupted run picks them up again.
+def _move_children(model, archive_model, parent_column, parent_ids,
+                   batch_size):
+    while True:
+        child_ids = db.session.scalars(
+            select(model.id).where(parent_column.in_(parent_ids))
+            .order_by(model.id).limit(batch_size)
+        ).all()
+        if not child_ids:
+            return
+
+        _move_rows(model, archive_model, model.id.in_(child_ids))
+        db.session.commit()
+
+
+# Move soft-deleted shops and their products, hours and roles to the archive
+def archive_deleted_shops(batch_size=DEFAULT_BATCH_SIZE):
+    archived = 0
+    for shard in sharding.shard_keys():
+        with sharding.use_shard(shard):
+            archived += _archive_shop_batches(batch_size)
+    return archived
+
+
+def _archive_shop_batches(batch_size):
+    archived = 0
+    while True:
+        shop_ids = db.session.scalars(
+            select(Shop.id).where(Shop.is_deleted == db.true())
+            .order_by(Shop.id).limit(batch_size)
+        ).all()
+        if not shop_ids:
+            return archived
+
+        _move_children(Product, ProductArchive, Product.shop_id, shop_ids,
+                       batch_size)
+        _move_children(ShopHours, ShopHoursArchive, ShopHours.shop_id,
+                       shop_ids, batch_size)
+        _move_children(UserRole, UserRoleArchive, UserRole.shop_id, shop_ids,
+                       batch_size)
+        _move_rows(Shop, ShopArchive, Shop.id.in_(shop_ids))
+        db.session.commit()
+        db.session.expunge_all()
+        archived += len(shop_ids)
+
+
+# Move soft-deleted users and their roles to the archive
+def archive_deleted_users(batch_size=DEFAULT_BATCH_SIZE):
+    archived = 0
+    while True:
+        user_ids = db.session.scalars(
+            select(User.id).where(User.is_deleted == db.true())
+            .order_by(User.id).limit(batch_size)
+        ).all()
+        if not user_ids:
+            return archived
+
+        for shard in sharding.shard_keys():
+            with sharding.use_shard(shard):
+                _move_children(UserRole, UserRoleArchive, UserRole.user_id,
+                               user_ids, batch_size)
+        _move_rows(User, UserArchive, User.id.in_(user_ids))
+        db.session.commit()
+        db.session.expunge_all()
+        archived += len(user_ids)
+
+
+# CLI entry point, meant to be run from cron: flask archive-deleted
+@click.command('archive-deleted')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help='Number of shops or users moved per transaction.')
+@with_appcontext
+def archive_deleted_command(batch_size):
+    shops = archive_deleted_shops(batch_size)
+    users = archive_deleted_users(batch_size)
+    click.echo(f"Archived {shops} shops and {users} users")
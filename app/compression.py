@@ -0,0 +1,154 @@
+import gzip
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Response compression negotiated through Accept-Encoding. Bodies of GET
+# responses are compressed once per (ETag, encoding) and served from an LRU
+# cache of compressed bodies on later hits; streamed responses are
+# compressed chunk by chunk. brotli and zstd are used when installed.
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json', 'application/msgpack', 'text/plain', 'text/html',
+    'text/css', 'application/javascript',
+}
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+
+# Encodings in order of server preference, used to break quality ties
+def available_encodings():
+    encodings = []
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    encodings.append('gzip')
+    return encodings
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+# Return functions compressing one chunk and finishing the stream. Every
+# chunk is flushed so the client receives it as soon as it is produced.
+def _chunk_compressor(encoding):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return (lambda chunk: compressor.process(chunk) + compressor.flush(),
+                compressor.finish)
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        return (lambda chunk: compressor.compress(chunk) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressor.flush)
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return (lambda chunk: compressor.compress(chunk) + compressor.flush(
+        zlib.Z_SYNC_FLUSH), compressor.flush)
+
+
+def stream_compress(chunks, encoding):
+    compress_chunk, finish = _chunk_compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if chunk:
+            yield compress_chunk(chunk)
+    yield finish()
+
+
+# LRU cache of compressed bodies, bounded by their total size in bytes
+
+
+class PrecompressedCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+
+def _after_request(response):
+    if (response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = stream_compress(response.response, encoding)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+
+        if request.method == 'GET':
+            digest = hashlib.md5(body, usedforsecurity=False).hexdigest()
+            cache = current_app.extensions['compression_cache']
+            compressed = cache.get((digest, encoding))
+            if compressed is None:
+                compressed = compress(body, encoding)
+                cache.put((digest, encoding), compressed)
+            # Keep ETags set by the view, such as row versions
+            if 'ETag' not in response.headers:
+                response.set_etag(f"{digest}-{encoding}")
+        else:
+            compressed = compress(body, encoding)
+        response.set_data(compressed)
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_app(app):
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_CACHE_BYTES', 32 * 1024 * 1024)
+    app.extensions['compression_cache'] = PrecompressedCache(
+        app.config['COMPRESS_CACHE_BYTES'])
+    app.after_request(_after_request)
@@ -0,0 +1,175 @@
+import functools
+import hashlib
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app, make_response, request
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import IdempotencyKey
+from app.serializers import render
+
+# Idempotency-Key support for create endpoints. The first request with a key
+# claims it by inserting a row, which the primary key makes atomic across
+# workers; its response is then stored compressed on that row. Retries are
+# replayed from the row without running the view, and duplicates arriving
+# while the first request is still running wait for its response. A claim
+# without a response is a lease: once it runs out, the worker holding it is
+# assumed dead and a retry takes the key over.
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_WAIT = 5.0
+# Matches the default gunicorn worker timeout, after which a worker still
+# running the first request has been killed
+DEFAULT_LEASE = 30
+POLL_INTERVAL = 0.05
+MAX_KEY_LENGTH = 255
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# The same key may only be reused for the same request, in the same format
+def _fingerprint():
+    digest = hashlib.sha256(
+        f"{request.method} {request.path}\n"
+        f"{request.headers.get('Accept', '')}\n".encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+# Insert the claim row. Returns None when claimed, or the existing row.
+def _claim(key, fingerprint):
+    now = _utcnow()
+    expires_at = now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL'])
+    locked_until = now + timedelta(
+        seconds=current_app.config['IDEMPOTENCY_LEASE'])
+    db.session.add(IdempotencyKey(
+        key=key, fingerprint=fingerprint, expires_at=expires_at,
+        locked_until=locked_until))
+    try:
+        db.session.commit()
+        return None
+    except IntegrityError:
+        db.session.rollback()
+
+    record = db.session.get(IdempotencyKey, key)
+    if record is not None and record.expires_at <= now:
+        db.session.delete(record)
+        db.session.commit()
+        return _claim(key, fingerprint)
+    if (record is not None and record.status_code is None
+            and record.fingerprint == fingerprint
+            and record.locked_until <= now):
+        # The conditional UPDATE lets only one retry take over the claim
+        taken = db.session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key,
+                   IdempotencyKey.status_code.is_(None),
+                   IdempotencyKey.locked_until <= now)
+            .values(expires_at=expires_at, locked_until=locked_until)
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        if taken.rowcount == 1:
+            return None
+        return db.session.get(IdempotencyKey, key)
+    return record
+
+
+def _replay(record):
+    response = make_response(zlib.decompress(record.body), record.status_code)
+    response.content_type = record.content_type
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _store(key, response):
+    record = db.session.get(IdempotencyKey, key)
+    record.status_code = response.status_code
+    record.content_type = response.content_type
+    record.body = zlib.compress(response.get_data())
+    db.session.commit()
+
+
+def _release(key):
+    db.session.rollback()
+    db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key))
+    db.session.commit()
+
+
+def idempotent(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return render({"error": "Invalid Idempotency-Key"}), 400
+
+        fingerprint = _fingerprint()
+        deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+        while True:
+            record = _claim(key, fingerprint)
+            if record is None:
+                break
+            if record.fingerprint != fingerprint:
+                return render({"error": "Idempotency-Key was used for a "
+                               "different request"}), 422
+            if record.status_code is not None:
+                return _replay(record)
+            if time.monotonic() >= deadline:
+                return (render({"error": "A request with this "
+                                "Idempotency-Key is in progress"}),
+                        409, {"Retry-After": "1"})
+
+            # End the read transaction so the next poll sees new commits
+            db.session.rollback()
+            time.sleep(POLL_INTERVAL)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            _release(key)
+            raise
+
+        # Server errors are not replayed, so the client can retry them
+        if response.status_code >= 500:
+            _release(key)
+        else:
+            _store(key, response)
+        return response
+    return wrapper
+
+
+# CLI entry point, meant to be run from cron: flask purge-idempotency-keys
+@click.command('purge-idempotency-keys')
+@click.option('--batch-size', default=1000, show_default=True)
+@with_appcontext
+def purge_idempotency_keys_command(batch_size):
+    purged = 0
+    while True:
+        keys = db.session.scalars(
+            select(IdempotencyKey.key)
+            .where(IdempotencyKey.expires_at <= _utcnow())
+            .limit(batch_size)
+        ).all()
+        if not keys:
+            break
+        db.session.execute(
+            delete(IdempotencyKey).where(IdempotencyKey.key.in_(keys)))
+        db.session.commit()
+        purged += len(keys)
+    click.echo(f"Purged {purged} idempotency keys")
+
+
+def init_app(app):
+    app.config.setdefault('IDEMPOTENCY_TTL', DEFAULT_TTL)
+    app.config.setdefault('IDEMPOTENCY_WAIT', DEFAULT_WAIT)
+    app.config.setdefault('IDEMPOTENCY_LEASE', DEFAULT_LEASE)
+    app.cli.add_command(purge_idempotency_keys_command)
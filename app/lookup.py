@@ -0,0 +1,145 @@
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db, migrations, sharding
+from app.models import Shop, User, ShopArchive, UserArchive
+from app.phone import normalize_phone
+from app.serializers import serialize_many, project
+
+# Ranked, paginated lookup of shops and users by normalized phone number or
+# name prefix. Both searches are LIKE 'prefix%' on the indexed lookup
+# columns, which the database turns into a range seek. Wildcards in the
+# prefix are escaped.
+#
+# Ranking by length cannot follow the index order, so the database sorts
+# all rows matching the prefix before returning a page; the prefix keeps
+# that candidate set small. Only the first MAX_RESULTS ranked rows can be
+# paged through, which bounds the rows each shard returns for a page.
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = 100
+MAX_RESULTS = 1000
+
+
+# Parse lookup query arguments into (search, error_message)
+def parse_lookup_args(args):
+    phone = args.get('phone', '').strip()
+    name_prefix = args.get('name_prefix', '').strip()
+    if bool(phone) == bool(name_prefix):
+        return None, "Provide exactly one of phone or name_prefix"
+    # A phone without digits would normalize to a bare country code prefix
+    if phone and not any(char.isdigit() for char in phone):
+        return None, "phone must contain digits"
+
+    try:
+        page = int(args.get('page', 1))
+        per_page = int(args.get('per_page', DEFAULT_PER_PAGE))
+    except ValueError:
+        return None, "page and per_page must be integers"
+    if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+        return None, f"page must be positive and per_page between 1 and {MAX_PER_PAGE}"
+    if page * per_page > MAX_RESULTS:
+        return None, f"Only the first {MAX_RESULTS} results can be paged through"
+
+    if phone:
+        search = {"column": "phone_normalized", "value": normalize_phone(phone)}
+    else:
+        search = {"column": "name_search", "value": name_prefix.lower()}
+    search.update(page=page, per_page=per_page)
+    return search, None
+
+
+# Exact matches first, then shorter values, then by id
+def _rank(obj, column, value):
+    found = getattr(obj, column)
+    return (found != value, len(found), found, obj.id)
+
+
+def lookup(model, search, fields=None):
+    column = getattr(model, search["column"])
+    value = search["value"]
+    offset = (search["page"] - 1) * search["per_page"]
+    limit = search["per_page"] + 1
+
+    query = (project(model.query, model, fields, extra=[search["column"]])
+             .filter(column.startswith(value, autoescape=True),
+                     model.is_deleted == db.false())
+             .order_by(sa.case((column == value, 0), else_=1),
+                       sa.func.length(column), column, model.id))
+
+    if model is Shop and sharding.is_enabled():
+        # Each shard returns its best rows; merge them with the same ranking
+        rows = sharding.scatter(query.limit(offset + limit).all)
+        rows.sort(key=lambda obj: _rank(obj, search["column"], value))
+        page_rows = rows[offset:offset + limit]
+    else:
+        page_rows = query.offset(offset).limit(limit).all()
+
+    return {
+        "items": serialize_many(page_rows[:search["per_page"]], fields),
+        "page": search["page"],
+        "per_page": search["per_page"],
+        "has_more": len(page_rows) > search["per_page"],
+    }
+
+
+# Add the lookup columns and indexes to existing shop and user tables. The
+# archive tables get the columns too, since archival copies every column.
+def _add_lookup_columns(engine, tables):
+    tables = migrations.add_columns(engine, tables,
+                                    ['phone_normalized', 'name_search'])
+    migrations.add_indexes(engine, tables, [
+        f"ix_{table.name}_{name}" for table in tables
+        for name in ('phone_normalized', 'name_search')])
+
+
+def _backfill_table(table, batch_size):
+    filled = 0
+    update = (sa.update(table)
+              .where(table.c.id == sa.bindparam('row_id'))
+              .values(phone_normalized=sa.bindparam('phone'),
+                      name_search=sa.bindparam('search')))
+    while True:
+        rows = db.session.execute(
+            sa.select(table.c.id, table.c.phone_number, table.c.name)
+            .where(table.c.phone_normalized.is_(None))
+            .order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return filled
+
+        # Core update so the backfill does not bump row versions
+        db.session.execute(update, [
+            {"row_id": row.id, "phone": normalize_phone(row.phone_number),
+             "search": str(row.name).lower()}
+            for row in rows
+        ])
+        db.session.commit()
+        filled += len(rows)
+
+
+# Migration for databases created before the lookup columns existed
+def backfill_lookup_columns(batch_size=500):
+    _add_lookup_columns(db.engine, [Shop.__table__, User.__table__,
+                                    ShopArchive.__table__,
+                                    UserArchive.__table__])
+    for engine in current_app.extensions['shard_engines'].values():
+        _add_lookup_columns(engine, [Shop.__table__, ShopArchive.__table__])
+
+    shops = 0
+    for shard in sharding.shard_keys():
+        with sharding.use_shard(shard):
+            shops += _backfill_table(Shop.__table__, batch_size)
+    users = _backfill_table(User.__table__, batch_size)
+    return shops, users
+
+
+# CLI entry point: flask backfill-lookup-columns
+@click.command('backfill-lookup-columns')
+@click.option('--batch-size', default=500, show_default=True)
+@with_appcontext
+def backfill_lookup_columns_command(batch_size):
+    shops, users = backfill_lookup_columns(batch_size)
+    click.echo(f"Backfilled {shops} shops and {users} users")
@@ -0,0 +1,255 @@
+import bisect
+import functools
+import glob
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from time import perf_counter
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Each worker process writes its samples to its own memory-mapped file in
+# METRICS_DIR; /metrics sums the files of every worker. Counters and histogram
+# buckets are plain sums, so this aggregates correctly across gunicorn workers.
+
+DEFAULT_METRICS_DIR = os.path.join(tempfile.gettempdir(), 'every_backend_metrics')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# name: (type, help, buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Total HTTP requests by endpoint, method and status.', None),
+    'http_request_duration_seconds': (
+        'histogram', 'HTTP request latency by endpoint.', LATENCY_BUCKETS),
+    'http_response_size_bytes': (
+        'histogram', 'HTTP response body size by endpoint.', SIZE_BUCKETS),
+    'db_query_duration_seconds': (
+        'histogram', 'Time spent in database queries per request.',
+        LATENCY_BUCKETS),
+}
+
+# Store of float values keyed by string, backed by a memory-mapped file.
+# Layout: 8 byte header holding the used size, then entries made of a 4 byte
+# key length, the key padded to 8 bytes and an 8 byte double.
+
+
+class MmapValues:
+    _INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self._file = open(path, 'a+b')
+        size = max(os.fstat(self._file.fileno()).st_size, self._INITIAL_SIZE)
+        self._file.truncate(size)
+        self._capacity = size
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._used = struct.unpack_from('i', self._mmap, 0)[0] or 8
+        self._positions = {key: position for key, _, position
+                           in _read_entries(self._mmap, self._used)}
+        self._lock = threading.Lock()
+
+    def add(self, key, amount):
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._add_key(key)
+            value = struct.unpack_from('d', self._mmap, position)[0]
+            struct.pack_into('d', self._mmap, position, value + amount)
+
+    def _add_key(self, key):
+        encoded = key.encode('utf-8')
+        padded = 8 * ((len(encoded) + 4 + 7) // 8) - 4
+        entry = struct.pack(f'i{padded}sd', len(encoded), encoded, 0.0)
+
+        while self._used + len(entry) > self._capacity:
+            self._capacity *= 2
+            self._file.truncate(self._capacity)
+            self._mmap.close()
+            self._mmap = mmap.mmap(self._file.fileno(), self._capacity)
+
+        self._mmap[self._used:self._used + len(entry)] = entry
+        self._used += len(entry)
+        struct.pack_into('i', self._mmap, 0, self._used)
+
+        position = self._used - 8
+        self._positions[key] = position
+        return position
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def _read_entries(data, used):
+    position = 8
+    while position < used:
+        length = struct.unpack_from('i', data, position)[0]
+        key = bytes(data[position + 4:position + 4 + length]).decode('utf-8')
+        position += 8 * ((length + 4 + 7) // 8)
+        yield key, struct.unpack_from('d', data, position)[0], position
+        position += 8
+
+
+def _read_file(path):
+    with open(path, 'rb') as metrics_file:
+        data = metrics_file.read()
+    if len(data) < 8:
+        return
+    used = struct.unpack_from('i', data, 0)[0]
+    for key, value, _ in _read_entries(data, used):
+        yield key, value
+
+
+# Stores are per process: a forked worker opens its own file on first use
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _store(directory):
+    pid = os.getpid()
+    store = _stores.get(directory)
+    if store is not None and store[0] == pid:
+        return store[1]
+
+    with _stores_lock:
+        os.makedirs(directory, exist_ok=True)
+        values = MmapValues(os.path.join(directory, f"metrics_{pid}.db"))
+        _stores[directory] = (pid, values)
+        return values
+
+
+# Labels are tuples of (name, value) pairs; encoded keys are cached so the
+# hot path only does a dict lookup and a struct write per sample
+@functools.lru_cache(maxsize=4096)
+def _key(name, suffix, labels):
+    return json.dumps([name, suffix, labels])
+
+
+def inc(directory, name, labels, amount=1.0):
+    _store(directory).add(_key(name, '', labels), amount)
+
+
+def observe(directory, name, labels, value):
+    store = _store(directory)
+    buckets = METRICS[name][2]
+    index = bisect.bisect_left(buckets, value)
+    le = str(float(buckets[index])) if index < len(buckets) else '+Inf'
+    store.add(_key(name, '_bucket', labels + (('le', le),)), 1.0)
+    store.add(_key(name, '_sum', labels), value)
+    store.add(_key(name, '_count', labels), 1.0)
+
+
+# Sum the samples of every process file into {(name, suffix, labels): value}
+def collect(directory):
+    samples = {}
+    for path in glob.glob(os.path.join(directory, 'metrics_*.db')):
+        for key, value in _read_file(path):
+            name, suffix, labels = json.loads(key)
+            sample = (name, suffix, tuple(tuple(label) for label in labels))
+            samples[sample] = samples.get(sample, 0.0) + value
+    return samples
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        name, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels)
+    return '{' + pairs + '}'
+
+
+# Render the aggregated samples in the Prometheus text exposition format
+def generate_latest(directory):
+    samples = collect(directory)
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        metric_samples = {(suffix, labels): value
+                          for (sample_name, suffix, labels), value in samples.items()
+                          if sample_name == name}
+
+        if metric_type == 'counter':
+            for (_, labels), value in sorted(metric_samples.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+
+        # Buckets are stored per bucket and exposed cumulatively
+        series = sorted({labels for suffix, labels in metric_samples
+                         if suffix != '_bucket'})
+        for labels in series:
+            cumulative = 0.0
+            for le in [str(float(bound)) for bound in buckets] + ['+Inf']:
+                cumulative += metric_samples.get(
+                    ('_bucket', labels + (('le', le),)), 0.0)
+                lines.append(f"{name}_bucket"
+                             f"{_format_labels(labels + (('le', le),))} "
+                             f"{cumulative}")
+            for suffix in ('_sum', '_count'):
+                lines.append(f"{name}{suffix}{_format_labels(labels)} "
+                             f"{metric_samples.get((suffix, labels), 0.0)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _before_request():
+    g.metrics_start = perf_counter()
+    g.db_time = 0.0
+
+
+def _make_after_request(directory):
+    def _after_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None or request.endpoint == 'metrics':
+            return response
+
+        endpoint = (('endpoint', request.endpoint or 'unmatched'),)
+        inc(directory, 'http_requests_total', endpoint + (
+            ('method', request.method), ('status', str(response.status_code))))
+        observe(directory, 'http_request_duration_seconds', endpoint,
+                perf_counter() - start)
+        observe(directory, 'db_query_duration_seconds', endpoint,
+                g.pop('db_time', 0.0))
+        if response.content_length is not None:
+            observe(directory, 'http_response_size_bytes', endpoint,
+                    response.content_length)
+        return response
+    return _after_request
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'db_time' in g:
+        g.db_time += elapsed
+
+
+# Record request metrics for every endpoint and expose them at /metrics
+def init_app(app):
+    directory = app.config.get('METRICS_DIR') or DEFAULT_METRICS_DIR
+    app.config['METRICS_DIR'] = directory
+
+    app.before_request(_before_request)
+    app.after_request(_make_after_request(directory))
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    def metrics():
+        return Response(
+            generate_latest(directory),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,104 @@
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app import db
+from app.models import (Shop, ShopHours, Product, User, UserRole,
+                        ShopArchive, ProductArchive, UserArchive)
+
+# Schema changes for databases created before a column or index existed.
+# Columns are added with ALTER TABLE and indexes created on the default bind
+# and on every shard; tables a database does not have are skipped.
+
+# Tables that got the version column used for optimistic concurrency
+VERSIONED_TABLES = [Shop.__table__, Product.__table__, User.__table__,
+                    ShopArchive.__table__, ProductArchive.__table__,
+                    UserArchive.__table__]
+
+# Indexes added for archival: the filtered indexes on live and soft-deleted
+# rows, and the ones used to find the children of the archived rows
+ARCHIVE_INDEXES = {
+    Shop.__table__: ['ix_shop_live', 'ix_shop_deleted'],
+    User.__table__: ['ix_user_live', 'ix_user_deleted'],
+    ShopHours.__table__: ['ix_shop_hours_shop_id'],
+    Product.__table__: ['ix_product_shop_id'],
+    UserRole.__table__: ['ix_user_role_shop_id', 'ix_user_role_user_id'],
+}
+
+
+def engines():
+    return [db.engine, *current_app.extensions['shard_engines'].values()]
+
+
+# Return the column definition used in ALTER TABLE ... ADD. NOT NULL columns
+# need their scalar default, which also fills the existing rows.
+def _column_ddl(engine, column):
+    quote = engine.dialect.identifier_preparer.quote
+    ddl = f"{quote(column.name)} {column.type.compile(engine.dialect)}"
+    if not column.nullable:
+        default = column.default.arg
+        ddl += f" NOT NULL DEFAULT {default}"
+    return ddl
+
+
+# Add the named columns to the tables that lack them. Returns the names of
+# the tables that exist on the engine.
+def add_columns(engine, tables, names):
+    inspector = sa.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    found = []
+    with engine.begin() as connection:
+        for table in tables:
+            if not inspector.has_table(table.name):
+                continue
+            found.append(table)
+            existing = {column['name']
+                        for column in inspector.get_columns(table.name)}
+            for name in names:
+                if name not in existing:
+                    connection.execute(sa.text(
+                        f"ALTER TABLE {quote(table.name)} "
+                        f"ADD {_column_ddl(engine, table.c[name])}"))
+    return found
+
+
+# Create the named indexes of the tables that lack them
+def add_indexes(engine, tables, names):
+    inspector = sa.inspect(engine)
+    with engine.begin() as connection:
+        for table in tables:
+            if not inspector.has_table(table.name):
+                continue
+            for index in table.indexes:
+                if index.name in names:
+                    index.create(connection, checkfirst=True)
+
+
+def add_version_columns():
+    checked = 0
+    for engine in engines():
+        checked += len(add_columns(engine, VERSIONED_TABLES, ['version']))
+    return checked
+
+
+# CLI entry point: flask add-version-columns
+@click.command('add-version-columns')
+@with_appcontext
+def add_version_columns_command():
+    tables = add_version_columns()
+    click.echo(f"Checked the version column on {tables} tables")
+
+
+def add_archive_indexes():
+    for engine in engines():
+        for table, names in ARCHIVE_INDEXES.items():
+            add_indexes(engine, [table], names)
+
+
+# CLI entry point: flask add-archive-indexes
+@click.command('add-archive-indexes')
+@with_appcontext
+def add_archive_indexes_command():
+    add_archive_indexes()
+    click.echo("Created the missing archive indexes")
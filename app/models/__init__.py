@@ -1,2 +1,6 @@
-from .shop import Shop, ShopHours, Product, Category
+from .shop import (Shop, ShopHours, Product, Category, ShopDirectory,
+                   ShardedId)
 from .user import User, UserRole
+from .archive import (ShopArchive, ShopHoursArchive, ProductArchive,
+                      UserArchive, UserRoleArchive)
+from .idempotency import IdempotencyKey
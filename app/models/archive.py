@@ -0,0 +1,86 @@
+from app import db, serializers
+
+# Archive tables hold soft-deleted rows moved out of the hot tables by
+# app.archive. Primary keys keep the original ids and carry no foreign keys,
+# so rows can be copied in any order. The hot tables never reuse ids, see
+# sqlite_autoincrement on their models.
+
+# Define the ShopArchive model
+
+
+class ShopArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    phone_number = db.Column(db.String(15), nullable=False)
+    is_deleted = db.Column(db.Boolean, nullable=False, default=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    phone_normalized = db.Column(db.String(20))
+    name_search = db.Column(db.String(100))
+    archived_at = db.Column(db.DateTime, nullable=False,
+                            default=db.func.current_timestamp())
+
+# Define the ShopHoursArchive model
+
+
+class ShopHoursArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shop_id = db.Column(db.Integer, nullable=False, index=True)
+    day_of_week = db.Column(db.Integer, nullable=False)
+    open_time = db.Column(db.String(5), nullable=False)
+    close_time = db.Column(db.String(5), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False,
+                            default=db.func.current_timestamp())
+
+# Define the ProductArchive model
+
+
+class ProductArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    shop_id = db.Column(db.Integer, nullable=False, index=True)
+    category_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    archived_at = db.Column(db.DateTime, nullable=False,
+                            default=db.func.current_timestamp())
+
+# Define the UserArchive model
+
+
+class UserArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    phone_number = db.Column(db.String(15), nullable=False)
+    is_deleted = db.Column(db.Boolean, nullable=False, default=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    phone_normalized = db.Column(db.String(20))
+    name_search = db.Column(db.String(100))
+    archived_at = db.Column(db.DateTime, nullable=False,
+                            default=db.func.current_timestamp())
+
+# Define the UserRoleArchive model
+
+
+class UserRoleArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    shop_id = db.Column(db.Integer, nullable=False, index=True)
+    role = db.Column(db.String(10), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False,
+                            default=db.func.current_timestamp())
+
+
+# Fields exposed by each model, see app.serializers
+serializers.register(ShopArchive, ["id", "name", "latitude", "longitude",
+                                   "phone_number", "is_deleted",
+                                   "archived_at"])
+serializers.register(ShopHoursArchive, ["id", "shop_id", "day_of_week",
+                                        "open_time", "close_time"])
+serializers.register(ProductArchive, ["id", "shop_id", "category_id", "name",
+                                      "amount", "price"])
+serializers.register(UserArchive, ["id", "name", "phone_number", "is_deleted",
+                                   "archived_at"])
+serializers.register(UserRoleArchive, ["id", "user_id", "shop_id", "role"])
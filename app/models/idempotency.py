@@ -0,0 +1,15 @@
+from app import db
+
+# Define the IdempotencyKey model, holding the first response sent for each
+# Idempotency-Key. status_code stays empty while that first request runs,
+# which holds the key until locked_until.
+
+
+class IdempotencyKey(db.Model):
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    body = db.Column(db.LargeBinary)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    locked_until = db.Column(db.DateTime, nullable=False)
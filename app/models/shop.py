@@ -1,4 +1,7 @@
-from app import db
+from sqlalchemy.orm import validates
+
+from app import db, serializers
+from app.phone import normalize_phone
 
 # Define the Shop model
 
@@ -10,40 +13,61 @@ class Shop(db.Model):
     longitude = db.Column(db.Float, nullable=False)
     phone_number = db.Column(db.String(15), nullable=False)
     is_deleted = db.Column(db.Boolean, nullable=False, default=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Lookup columns, same as User
+    phone_normalized = db.Column(db.String(20), index=True)
+    name_search = db.Column(db.String(100), index=True)
 
     # Define relationships
     hours = db.relationship('ShopHours', backref='shop', lazy=True)
     roles = db.relationship('UserRole', back_populates='shop')
     products = db.relationship('Product', back_populates='shop', lazy=True)
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "latitude": self.latitude,
-            "longitude": self.longitude,
-            "phone_number": self.phone_number,
-            "is_deleted": self.is_deleted
-        }
+    # Filtered indexes: live rows are covered for the default
+    # filter_by(is_deleted=False) reads, so the include list must hold every
+    # column the ORM selects, and soft-deleted rows waiting for archival are
+    # found without scanning the table. AUTOINCREMENT keeps SQLite from
+    # reusing the id of a row moved to the archive.
+    __table_args__ = (
+        db.Index('ix_shop_live', id,
+                 sqlite_where=is_deleted == db.false(),
+                 mssql_where=is_deleted == db.false(),
+                 mssql_include=['name', 'latitude', 'longitude', 'phone_number',
+                                'is_deleted', 'version', 'phone_normalized',
+                                'name_search']),
+        db.Index('ix_shop_deleted', is_deleted,
+                 sqlite_where=is_deleted == db.true(),
+                 mssql_where=is_deleted == db.true()),
+        {'sqlite_autoincrement': True},
+    )
+
+    # Every UPDATE checks and bumps version, for optimistic concurrency
+    __mapper_args__ = {'version_id_col': version}
+
+    @validates('phone_number')
+    def _set_phone_normalized(self, key, phone_number):
+        self.phone_normalized = (normalize_phone(phone_number)
+                                 if phone_number is not None else None)
+        return phone_number
+
+    @validates('name')
+    def _set_name_search(self, key, name):
+        self.name_search = str(name).lower() if name is not None else None
+        return name
 
 # Define the ShopHours model
 
 
 class ShopHours(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False,
+                        index=True)
     day_of_week = db.Column(db.Integer, nullable=False, unique=True)
     open_time = db.Column(db.String(5), nullable=False)
     close_time = db.Column(db.String(5), nullable=False)
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "shop_id": self.shop_id,
-            "day_of_week": self.day_of_week,
-            "open_time": self.open_time,
-            "close_time": self.close_time
-        }
+    __table_args__ = {'sqlite_autoincrement': True}
 
 # Define the Category model
 
@@ -55,36 +79,52 @@ class Category(db.Model):
     # Define relationship
     products = db.relationship('Product', back_populates='category', lazy=True)
 
-    # Method to return dictionary representation of the category
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "name": self.name
-        }
-
 # Define the Product model
 
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False,
+                        index=True)
     category_id = db.Column(db.Integer, db.ForeignKey(
         'category.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
     amount = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
 
     # Define relationships
     shop = db.relationship('Shop', back_populates='products')
     category = db.relationship('Category', back_populates='products')
 
-    # Method to return dictionary representation of the product
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "shop_id": self.shop_id,
-            "category_id": self.category_id,
-            "name": self.name,
-            "amount": self.amount,
-            "price": self.price
-        }
+    __table_args__ = {'sqlite_autoincrement': True}
+    __mapper_args__ = {'version_id_col': version}
+
+# Define the ShopDirectory model, mapping each shop to the shard holding it.
+# It lives on the default bind and also hands out globally unique shop ids.
+
+
+class ShopDirectory(db.Model):
+    shop_id = db.Column(db.Integer, primary_key=True)
+    shard = db.Column(db.String(50), nullable=False)
+    is_moving = db.Column(db.Boolean, nullable=False, default=False)
+
+# Define the ShardedId model. Like ShopDirectory for shops, it lives on the
+# default bind and hands out ids for shop hours, products and user roles that
+# are unique across shards, so their rows can move between shards.
+
+
+class ShardedId(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+
+
+# Fields exposed by each model, see app.serializers
+serializers.register(Shop, ["id", "name", "latitude", "longitude",
+                            "phone_number", "is_deleted", "version"])
+serializers.register(ShopHours, ["id", "shop_id", "day_of_week",
+                                 "open_time", "close_time"])
+serializers.register(Category, ["id", "name"])
+serializers.register(Product, ["id", "shop_id", "category_id", "name",
+                               "amount", "price", "version"])
+serializers.register(ShopDirectory, ["shop_id", "shard", "is_moving"])
@@ -1,4 +1,7 @@
-from app import db
+from sqlalchemy.orm import validates
+
+from app import db, serializers
+from app.phone import normalize_phone
 
 # Define the User model
 
@@ -8,17 +11,41 @@ class User(db.Model):
     name = db.Column(db.String(100), nullable=False)
     phone_number = db.Column(db.String(15), nullable=False)
     is_deleted = db.Column(db.Boolean, nullable=False, default=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Lookup columns kept in sync with phone_number and name, indexed for
+    # the /users/lookup seeks
+    phone_normalized = db.Column(db.String(20), index=True)
+    name_search = db.Column(db.String(100), index=True)
 
     # Define relationship
     roles = db.relationship('UserRole', back_populates='user')
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "name": self.name,
-            "phone_number": self.phone_number,
-            "is_deleted": self.is_deleted
-        }
+    # Same filtered is_deleted indexes and AUTOINCREMENT as Shop
+    __table_args__ = (
+        db.Index('ix_user_live', id,
+                 sqlite_where=is_deleted == db.false(),
+                 mssql_where=is_deleted == db.false(),
+                 mssql_include=['name', 'phone_number', 'is_deleted',
+                                'version', 'phone_normalized', 'name_search']),
+        db.Index('ix_user_deleted', is_deleted,
+                 sqlite_where=is_deleted == db.true(),
+                 mssql_where=is_deleted == db.true()),
+        {'sqlite_autoincrement': True},
+    )
+
+    __mapper_args__ = {'version_id_col': version}
+
+    @validates('phone_number')
+    def _set_phone_normalized(self, key, phone_number):
+        self.phone_normalized = (normalize_phone(phone_number)
+                                 if phone_number is not None else None)
+        return phone_number
+
+    @validates('name')
+    def _set_name_search(self, key, name):
+        self.name_search = str(name).lower() if name is not None else None
+        return name
 
 
 # Define the UserRole model
@@ -26,18 +53,20 @@ class User(db.Model):
 
 class UserRole(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False,
+                        index=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False,
+                        index=True)
     role = db.Column(db.String(10), nullable=False)  # 'staff' or 'admin'
 
     # Define relationships
     user = db.relationship('User', backref='user_roles')
     shop = db.relationship('Shop', backref='shop_roles')
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "user_id": self.user_id,
-            "shop_id": self.shop_id,
-            "role": self.role
-        }
+    __table_args__ = {'sqlite_autoincrement': True}
+
+
+# Fields exposed by each model, see app.serializers
+serializers.register(User, ["id", "name", "phone_number", "is_deleted",
+                            "version"])
+serializers.register(UserRole, ["id", "user_id", "shop_id", "role"])
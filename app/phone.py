@@ -0,0 +1,23 @@
+import re
+
+from flask import current_app, has_app_context
+
+DEFAULT_COUNTRY_CODE = '1'
+
+
+# Normalize a phone number to E.164 style: '+', country code, then digits.
+# Numbers without an international prefix get PHONE_COUNTRY_CODE, after
+# dropping the national trunk prefix (leading zeros). Numbers sent as JSON
+# numbers are accepted too.
+def normalize_phone(raw, country_code=None):
+    if country_code is None:
+        country_code = (current_app.config['PHONE_COUNTRY_CODE']
+                        if has_app_context() else DEFAULT_COUNTRY_CODE)
+
+    raw = str(raw).strip()
+    digits = re.sub(r'\D', '', raw)
+    if raw.startswith('+'):
+        return '+' + digits
+    if digits.startswith('00'):
+        return '+' + digits[2:]
+    return f"+{country_code}{digits.lstrip('0')}"
@@ -0,0 +1,92 @@
+import gc
+from time import perf_counter
+
+from flask import current_app, jsonify
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import configure_mappers
+
+from app import db
+from app.models import Shop, ShopHours, Product, User, UserRole, ShopDirectory
+
+# Startup work done once in the gunicorn master before it forks the workers
+# (preload_app in gunicorn.conf.py): configure the mappers, fill the
+# engines' compiled statement cache with the hot queries and freeze the
+# resulting heap so the workers share it copy-on-write. The report of where
+# startup time went is served at /startup.
+
+
+# Run the statements behind the hot routes with keys that match no row. The
+# compiled SQL is cached per statement shape, not per parameter value.
+def _run_hot_queries():
+    db.session.get(Shop, 0)
+    db.session.get(Product, 0)
+    db.session.get(User, 0)
+    db.session.get(ShopDirectory, 0)
+    Product.query.filter_by(shop_id=0).all()
+    ShopHours.query.filter_by(shop_id=0, day_of_week=0).first()
+    UserRole.query.filter_by(user_id=0, shop_id=0).first()
+
+
+def _engines(app):
+    return [*db.engines.values(), *app.extensions['shard_engines'].values()]
+
+
+def warm_up(app, started_at=None, import_times=None):
+    start = perf_counter()
+    with app.app_context():
+        configure_mappers()
+        try:
+            _run_hot_queries()
+        except DBAPIError as error:
+            app.logger.warning("Skipping query cache warm-up: %s", error)
+        finally:
+            db.session.remove()
+
+        # Workers open their own connections, the master keeps none
+        for engine in _engines(app):
+            engine.dispose()
+
+    # Move everything allocated so far out of the collector's reach, so
+    # collections in the workers do not touch (and copy) the shared pages
+    gc.collect()
+    gc.freeze()
+
+    report = app.extensions['startup_report']
+    report['imports'] = import_times or {}
+    report['warm_up'] = perf_counter() - start
+    if started_at is not None:
+        report['ready'] = perf_counter() - started_at
+        report['worker_started_at'] = started_at
+
+
+# Called in each worker right after fork
+def post_fork(app):
+    with app.app_context():
+        # Drop the pooled connections inherited from the master without
+        # closing them, since the master's sockets are shared
+        for engine in _engines(app):
+            engine.dispose(close=False)
+    app.extensions['startup_report']['worker_started_at'] = perf_counter()
+
+
+def _record_first_request():
+    report = current_app.extensions['startup_report']
+    if 'first_request' in report or 'worker_started_at' not in report:
+        return
+    report['first_request'] = perf_counter() - report['worker_started_at']
+    current_app.logger.info("Startup report: %s", _public(report))
+
+
+def _public(report):
+    return {key: value for key, value in report.items()
+            if key != 'worker_started_at'}
+
+
+def startup_report():
+    return jsonify(_public(current_app.extensions['startup_report']))
+
+
+def init_app(app):
+    app.extensions['startup_report'] = {}
+    app.before_request(_record_first_request)
+    app.add_url_rule('/startup', 'startup_report', startup_report)
@@ -0,0 +1,200 @@
+import os
+import random
+import sys
+import threading
+import time
+from time import perf_counter
+
+import click
+from flask import current_app, g, jsonify, request, send_from_directory
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Sampling profiler for individual requests. A request is profiled when it
+# carries a valid signed X-Profile header, when it falls in the configured
+# sample rate, or, if a latency threshold is set, speculatively with the
+# profile kept only when the request turns out to be slow. Profiles are
+# written as collapsed stacks, which flamegraph.pl and speedscope both load.
+
+PROFILE_HEADER = 'X-Profile'
+TOKEN_SALT = 'profile'
+
+# Samples the stacks of the threads currently serving profiled requests
+
+
+class Sampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+
+    def start(self, thread_id):
+        with self._lock:
+            self._active[thread_id] = {}
+            # Threads do not survive fork, so each worker starts its own
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+        self._wake.set()
+
+    def stop(self, thread_id):
+        with self._lock:
+            return self._active.pop(thread_id, {})
+
+    def _run(self):
+        while True:
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for thread_id, counts in active.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stack = _collapse(frame)
+                    counts[stack] = counts.get(stack, 0) + 1
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} "
+                     f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def make_token(app):
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'],
+                                  salt=TOKEN_SALT).dumps('profile')
+
+
+def _has_valid_token(app):
+    token = request.headers.get(PROFILE_HEADER)
+    if not token or not app.config['SECRET_KEY']:
+        return False
+    try:
+        URLSafeTimedSerializer(app.config['SECRET_KEY'], salt=TOKEN_SALT).loads(
+            token, max_age=app.config['PROFILE_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return False
+    return True
+
+
+# Endpoints serving the profiles, which are not profiled themselves
+PROFILE_ENDPOINTS = ('list_profiles', 'get_profile')
+
+
+def _before_request():
+    if request.endpoint in PROFILE_ENDPOINTS:
+        return
+
+    app = current_app._get_current_object()
+    forced = (_has_valid_token(app)
+              or random.random() < app.config['PROFILE_SAMPLE_RATE'])
+    if not forced and app.config['PROFILE_LATENCY_THRESHOLD'] is None:
+        return
+
+    g.profile_forced = forced
+    g.profile_start = perf_counter()
+    app.extensions['profiler'].start(threading.get_ident())
+
+
+def _teardown_request(exc):
+    start = g.pop('profile_start', None)
+    if start is None:
+        return
+
+    app = current_app._get_current_object()
+    counts = app.extensions['profiler'].stop(threading.get_ident())
+    duration = perf_counter() - start
+    threshold = app.config['PROFILE_LATENCY_THRESHOLD']
+    if g.pop('profile_forced') or (threshold is not None and duration >= threshold):
+        write_profile(app, request.endpoint or 'unmatched', duration, counts)
+
+
+def write_profile(app, endpoint, duration, counts):
+    directory = app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    name = f"{time.time():.6f}_{endpoint}_{duration * 1000:.0f}ms.folded"
+    with open(os.path.join(directory, name), 'w') as profile_file:
+        for stack, count in sorted(counts.items()):
+            profile_file.write(f"{stack} {count}\n")
+
+    # Keep only the most recent profiles
+    for old_name in _profile_names(directory)[app.config['PROFILE_KEEP']:]:
+        os.remove(os.path.join(directory, old_name))
+
+
+# Profile file names, most recent first
+def _profile_names(directory):
+    if not os.path.isdir(directory):
+        return []
+    names = [name for name in os.listdir(directory) if name.endswith('.folded')]
+    return sorted(names, reverse=True)
+
+
+# Profiles show internal stack traces and file names, so reading them needs
+# the same signed X-Profile header as recording them
+def _forbidden():
+    return jsonify({"error": "A valid X-Profile header is required"}), 403
+
+
+def list_profiles():
+    if not _has_valid_token(current_app):
+        return _forbidden()
+
+    directory = current_app.config['PROFILE_DIR']
+    profiles = []
+    for name in _profile_names(directory):
+        created, rest = name[:-len('.folded')].split('_', 1)
+        endpoint, duration = rest.rsplit('_', 1)
+        profiles.append({
+            "name": name,
+            "endpoint": endpoint,
+            "duration_ms": int(duration[:-len('ms')]),
+            "created_at": float(created),
+        })
+    return jsonify(profiles)
+
+
+def get_profile(name):
+    if not _has_valid_token(current_app):
+        return _forbidden()
+
+    return send_from_directory(current_app.config['PROFILE_DIR'], name,
+                               mimetype='text/plain')
+
+
+# CLI entry point: flask profile-token, prints a value for the X-Profile header
+@click.command('profile-token')
+@with_appcontext
+def profile_token_command():
+    click.echo(make_token(current_app))
+
+
+# Register the profiling hooks and endpoints. Nothing is registered unless
+# PROFILING_ENABLED is set, so a disabled profiler costs nothing per request.
+def init_app(app):
+    app.cli.add_command(profile_token_command)
+    if not app.config.get('PROFILING_ENABLED'):
+        return
+
+    app.config.setdefault('PROFILE_DIR', os.path.join(app.instance_path,
+                                                      'profiles'))
+    app.config.setdefault('PROFILE_INTERVAL', 0.005)
+    app.config.setdefault('PROFILE_KEEP', 100)
+    app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+    app.extensions['profiler'] = Sampler(app.config['PROFILE_INTERVAL'])
+
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/profiles', 'list_profiles', list_profiles)
+    app.add_url_rule('/profiles/<path:name>', 'get_profile', get_profile)
@@ -1,30 +1,62 @@
-from flask import Blueprint, request, jsonify
-from app.models import Shop, ShopHours, Product, Category
-from app import db
+from flask import Blueprint, request
+from app.models import (Shop, ShopHours, Product, Category, ShopArchive,
+                        ShopHoursArchive, ProductArchive)
+from app import db, sharding
+from app.idempotency import idempotent
+from app.lookup import parse_lookup_args, lookup
+from app.serializers import (render, serialize, serialize_many,
+                             parse_fields, project)
+from app.routes.versioning import (validate_patch_data, check_if_match,
+                                   commit_or_conflict, versioned_response)
 
 bp = Blueprint('shop', __name__, url_prefix='/shops')
 
+# Fields a client may change with PATCH
+SHOP_FIELDS = ["name", "latitude", "longitude", "phone_number"]
+PRODUCT_FIELDS = ["name", "amount", "price", "category_id"]
+
 
 @bp.route('/', methods=['GET'])
 def get_shops():
-    shops = Shop.query.filter_by(is_deleted=False).all()
-    return jsonify([shop.to_dict() for shop in shops])
+    fields, error_message = parse_fields(Shop, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+
+    shops = sharding.scatter(
+        lambda: project(Shop.query, Shop, fields).filter_by(is_deleted=False).all())
+    shops.sort(key=lambda shop: shop.id)
+    return render(serialize_many(shops, fields))
+
+
+@bp.route('/lookup', methods=['GET'])
+def lookup_shops():
+    search, error_message = parse_lookup_args(request.args)
+    if not error_message:
+        fields, error_message = parse_fields(Shop, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+    return render(lookup(Shop, search, fields))
 
 
 @bp.route('/<int:shop_id>', methods=['GET'])
 def get_shop(shop_id):
-    shop = Shop.query.get_or_404(shop_id)
+    fields, error_message = parse_fields(Shop, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+
+    shop = project(Shop.query, Shop, fields).get_or_404(shop_id)
     if shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
-    return jsonify(shop.to_dict())
+        return render({"error": "Shop not found"}), 404
+    return versioned_response(shop, fields=fields)
 
 
 @bp.route('/', methods=['POST'])
+@idempotent
 def create_shop():
     data = request.get_json()
     is_valid, error_message = validate_shop_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
 
     shop = Shop(
         name=data["name"],
@@ -32,51 +64,104 @@ def create_shop():
         longitude=data["longitude"],
         phone_number=data["phone_number"],
     )
-    db.session.add(shop)
-    db.session.commit()
+    with sharding.use_shard(sharding.allocate_shop(shop)):
+        db.session.add(shop)
+        db.session.commit()
 
-    return jsonify(shop.to_dict()), 201
+        return versioned_response(shop, 201)
 
 
 @bp.route('/<int:shop_id>', methods=['PUT'])
 def update_shop(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     if shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
+        return render({"error": "Shop not found"}), 404
 
     data = request.get_json()
     is_valid, error_message = validate_shop_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
+
+    precondition_error = check_if_match(shop)
+    if precondition_error:
+        return precondition_error
 
     shop.name = data["name"]
     shop.latitude = data["latitude"]
     shop.longitude = data["longitude"]
     shop.phone_number = data["phone_number"]
-    db.session.commit()
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
+
+    return versioned_response(shop)
+
+
+@bp.route('/<int:shop_id>', methods=['PATCH'])
+def patch_shop(shop_id):
+    shop = Shop.query.get_or_404(shop_id)
+    if shop.is_deleted:
+        return render({"error": "Shop not found"}), 404
+
+    data = request.get_json()
+    is_valid, error_message = validate_patch_data(data, SHOP_FIELDS)
+    if not is_valid:
+        return render({"error": error_message}), 400
+
+    precondition_error = check_if_match(shop)
+    if precondition_error:
+        return precondition_error
+
+    # Only attributes whose value changes end up in the UPDATE
+    for field, value in data.items():
+        setattr(shop, field, value)
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
 
-    return jsonify(shop.to_dict())
+    return versioned_response(shop)
 
 
 @bp.route('/<int:shop_id>', methods=['DELETE'])
 def delete_shop(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     if shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
+        return render({"error": "Shop not found"}), 404
+
+    precondition_error = check_if_match(shop)
+    if precondition_error:
+        return precondition_error
+
     shop.is_deleted = True
-    db.session.commit()
-    return jsonify({"message": "Shop deleted"})
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
+    return render({"message": "Shop deleted"})
+
+
+@bp.route('/archived/<int:shop_id>', methods=['GET'])
+def get_archived_shop(shop_id):
+    shop = ShopArchive.query.get_or_404(shop_id)
+    hours = ShopHoursArchive.query.filter_by(shop_id=shop_id).all()
+    products = ProductArchive.query.filter_by(shop_id=shop_id).all()
+
+    shop_data = serialize(shop)
+    shop_data["hours"] = serialize_many(hours)
+    shop_data["products"] = serialize_many(products)
+    return render(shop_data)
 
 
 def validate_shop_data(data):
     if not data:
         return False, "No data provided"
 
-    required_fields = ["name", "latitude", "longitude", "phone_number"]
+    required_fields = SHOP_FIELDS
 
     for field in required_fields:
         if field not in data:
             return False, f"Missing required field: {field}"
+        if data[field] is None:
+            return False, f"Field cannot be null: {field}"
 
     return True, None
 
@@ -98,19 +183,19 @@ def validate_shop_hours_data(data):
 def add_shop_hours(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     if shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
+        return render({"error": "Shop not found"}), 404
 
     data = request.get_json()
     is_valid, error_message = validate_shop_hours_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
 
     existing_hours = ShopHours.query.filter_by(
         shop_id=shop_id, day_of_week=data["day_of_week"]
     ).first()
 
     if existing_hours:
-        return jsonify({"error": "Hours already exist for this day of the week"}), 400
+        return render({"error": "Hours already exist for this day of the week"}), 400
 
     shop_hours = ShopHours(
         shop_id=shop_id,
@@ -118,17 +203,18 @@ def add_shop_hours(shop_id):
         open_time=data["open_time"],
         close_time=data["close_time"],
     )
+    sharding.allocate_id(shop_hours)
     db.session.add(shop_hours)
     db.session.commit()
 
-    return jsonify(shop_hours.to_dict()), 201
+    return render(serialize(shop_hours)), 201
 
 
 def validate_product_data(data):
     if not data:
         return False, "No data provided"
 
-    required_fields = ["name", "amount", "price", "category_id"]
+    required_fields = PRODUCT_FIELDS
 
     for field in required_fields:
         if field not in data:
@@ -138,15 +224,16 @@ def validate_product_data(data):
 
 
 @bp.route('/<int:shop_id>/products', methods=['POST'])
+@idempotent
 def create_product(shop_id):
     shop = Shop.query.get_or_404(shop_id)
     if shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
+        return render({"error": "Shop not found"}), 404
 
     data = request.get_json()
     is_valid, error_message = validate_product_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
 
     product = Product(
         shop_id=shop_id,
@@ -155,40 +242,77 @@ def create_product(shop_id):
         amount=data["amount"],
         price=data["price"],
     )
+    sharding.allocate_id(product)
     db.session.add(product)
     db.session.commit()
 
-    return jsonify(product.to_dict()), 201
+    return versioned_response(product, 201)
 
 
 @bp.route('/<int:shop_id>/products/<int:product_id>', methods=['PUT'])
 def update_product(shop_id, product_id):
     product = Product.query.get_or_404(product_id)
     if product.shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
+        return render({"error": "Shop not found"}), 404
 
     data = request.get_json()
     is_valid, error_message = validate_product_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
+
+    precondition_error = check_if_match(product)
+    if precondition_error:
+        return precondition_error
 
     product.category_id = data["category_id"]
     product.name = data["name"]
     product.amount = data["amount"]
     product.price = data["price"]
-    db.session.commit()
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
 
-    return jsonify(product.to_dict())
+    return versioned_response(product)
+
+
+@bp.route('/<int:shop_id>/products/<int:product_id>', methods=['PATCH'])
+def patch_product(shop_id, product_id):
+    product = Product.query.filter_by(
+        id=product_id, shop_id=shop_id).first_or_404()
+    if product.shop.is_deleted:
+        return render({"error": "Shop not found"}), 404
+
+    data = request.get_json()
+    is_valid, error_message = validate_patch_data(data, PRODUCT_FIELDS)
+    if not is_valid:
+        return render({"error": error_message}), 400
+
+    precondition_error = check_if_match(product)
+    if precondition_error:
+        return precondition_error
+
+    for field, value in data.items():
+        setattr(product, field, value)
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
+
+    return versioned_response(product)
 
 
 @bp.route('/<int:shop_id>/products', methods=['GET'])
 def list_products(shop_id):
+    fields, error_message = parse_fields(Product, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+
     shop = Shop.query.get_or_404(shop_id)
     if shop.is_deleted:
-        return jsonify({"error": "Shop not found"}), 404
+        return render({"error": "Shop not found"}), 404
 
-    products = Product.query.filter_by(shop_id=shop_id).all()
-    return jsonify([product.to_dict() for product in products])
+    products = project(Product.query, Product, fields).filter_by(
+        shop_id=shop_id).all()
+    return render(serialize_many(products, fields))
 
 
 def validate_category_data(data):
@@ -204,11 +328,12 @@ def validate_category_data(data):
 
 
 @bp.route('/categories', methods=['POST'])
+@idempotent
 def create_category():
     data = request.get_json()
     is_valid, error_message = validate_category_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
 
     category = Category(
         name=data["name"],
@@ -216,10 +341,14 @@ def create_category():
     db.session.add(category)
     db.session.commit()
 
-    return jsonify(category.to_dict()), 201
+    return render(serialize(category)), 201
 
 
 @bp.route('/categories', methods=['GET'])
 def list_categories():
-    categories = Category.query.all()
-    return jsonify([category.to_dict() for category in categories])
+    fields, error_message = parse_fields(Category, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+
+    categories = project(Category.query, Category, fields).all()
+    return render(serialize_many(categories, fields))
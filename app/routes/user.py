@@ -1,36 +1,66 @@
-from flask import Blueprint, request, jsonify
-from app.models import User, UserRole
-from app import db
+from flask import Blueprint, request
+from app.models import User, UserRole, UserArchive, UserRoleArchive
+from app import db, sharding
+from app.idempotency import idempotent
+from app.lookup import parse_lookup_args, lookup
+from app.serializers import (render, serialize, serialize_many,
+                             parse_fields, project)
+from app.routes.versioning import (validate_patch_data, check_if_match,
+                                   commit_or_conflict, versioned_response)
 
 bp = Blueprint('user', __name__, url_prefix='/users')
 
+# Fields a client may change with PATCH
+USER_FIELDS = ["name", "phone_number"]
+
 # Endpoint to get all non-deleted users
 
 
 @bp.route('/', methods=['GET'])
 def get_users():
-    users = User.query.filter_by(is_deleted=False).all()
-    return jsonify([user.to_dict() for user in users])
+    fields, error_message = parse_fields(User, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+
+    users = project(User.query, User, fields).filter_by(is_deleted=False).all()
+    return render(serialize_many(users, fields))
+
+# Endpoint to find users by phone number or name prefix
+
+
+@bp.route('/lookup', methods=['GET'])
+def lookup_users():
+    search, error_message = parse_lookup_args(request.args)
+    if not error_message:
+        fields, error_message = parse_fields(User, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+    return render(lookup(User, search, fields))
 
 # Endpoint to get a specific user by user_id
 
 
 @bp.route('/<int:user_id>', methods=['GET'])
 def get_user(user_id):
-    user = User.query.get_or_404(user_id)
+    fields, error_message = parse_fields(User, request.args)
+    if error_message:
+        return render({"error": error_message}), 400
+
+    user = project(User.query, User, fields).get_or_404(user_id)
     if user.is_deleted:
-        return jsonify({"error": "User not found"}), 404
-    return jsonify(user.to_dict())
+        return render({"error": "User not found"}), 404
+    return versioned_response(user, fields=fields)
 
 # Endpoint to create a new user
 
 
 @bp.route('/', methods=['POST'])
+@idempotent
 def create_user():
     data = request.get_json()
     is_valid, error_message = validate_user_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
 
     user = User(
         name=data["name"],
@@ -39,7 +69,7 @@ def create_user():
     db.session.add(user)
     db.session.commit()
 
-    return jsonify(user.to_dict()), 201
+    return versioned_response(user, 201)
 
 # Endpoint to update an existing user by user_id
 
@@ -48,18 +78,50 @@ def create_user():
 def update_user(user_id):
     user = User.query.get_or_404(user_id)
     if user.is_deleted:
-        return jsonify({"error": "User not found"}), 404
+        return render({"error": "User not found"}), 404
 
     data = request.get_json()
     is_valid, error_message = validate_user_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
+
+    precondition_error = check_if_match(user)
+    if precondition_error:
+        return precondition_error
 
     user.name = data["name"]
     user.phone_number = data["phone_number"]
-    db.session.commit()
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
+
+    return versioned_response(user)
 
-    return jsonify(user.to_dict())
+# Endpoint to partially update a user, sending only the changed fields
+
+
+@bp.route('/<int:user_id>', methods=['PATCH'])
+def patch_user(user_id):
+    user = User.query.get_or_404(user_id)
+    if user.is_deleted:
+        return render({"error": "User not found"}), 404
+
+    data = request.get_json()
+    is_valid, error_message = validate_patch_data(data, USER_FIELDS)
+    if not is_valid:
+        return render({"error": error_message}), 400
+
+    precondition_error = check_if_match(user)
+    if precondition_error:
+        return precondition_error
+
+    for field, value in data.items():
+        setattr(user, field, value)
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
+
+    return versioned_response(user)
 
 # Endpoint to delete a user by user_id
 
@@ -68,10 +130,31 @@ def update_user(user_id):
 def delete_user(user_id):
     user = User.query.get_or_404(user_id)
     if user.is_deleted:
-        return jsonify({"error": "User not found"}), 404
+        return render({"error": "User not found"}), 404
+
+    precondition_error = check_if_match(user)
+    if precondition_error:
+        return precondition_error
+
     user.is_deleted = True
-    db.session.commit()
-    return jsonify({"message": "User deleted"})
+    conflict = commit_or_conflict()
+    if conflict:
+        return conflict
+    return render({"message": "User deleted"})
+
+# Endpoint to get an archived user by user_id
+
+
+@bp.route('/archived/<int:user_id>', methods=['GET'])
+def get_archived_user(user_id):
+    user = UserArchive.query.get_or_404(user_id)
+    # Archived roles stay on the shard of their shop
+    roles = sharding.scatter(
+        lambda: UserRoleArchive.query.filter_by(user_id=user_id).all())
+
+    user_data = serialize(user)
+    user_data["roles"] = serialize_many(roles)
+    return render(user_data)
 
 # Endpoint to modify the user role for a specific user and shop
 
@@ -80,26 +163,33 @@ def delete_user(user_id):
 def modify_user_role(user_id):
     user = User.query.get_or_404(user_id)
     if user.is_deleted:
-        return jsonify({"error": "User not found"}), 404
+        return render({"error": "User not found"}), 404
 
     data = request.get_json()
     is_valid, error_message = validate_user_role_data(data)
     if not is_valid:
-        return jsonify({"error": error_message}), 400
+        return render({"error": error_message}), 400
 
-    user_role = UserRole.query.filter_by(
-        user_id=user_id, shop_id=data["shop_id"]).first()
+    moving_error = sharding.check_not_moving(data["shop_id"])
+    if moving_error:
+        return moving_error
 
-    if not user_role:
-        user_role = UserRole(
-            user_id=user_id, shop_id=data["shop_id"], role=data["role"])
-        db.session.add(user_role)
-    else:
-        user_role.role = data["role"]
+    # User roles live on the shard of the shop they grant access to
+    with sharding.use_shard(sharding.shard_for(data["shop_id"])):
+        user_role = UserRole.query.filter_by(
+            user_id=user_id, shop_id=data["shop_id"]).first()
 
-    db.session.commit()
+        if not user_role:
+            user_role = UserRole(
+                user_id=user_id, shop_id=data["shop_id"], role=data["role"])
+            sharding.allocate_id(user_role)
+            db.session.add(user_role)
+        else:
+            user_role.role = data["role"]
+
+        db.session.commit()
 
-    return jsonify(user_role.to_dict())
+        return render(serialize(user_role))
 
 # Validate user data for creation or update
 
@@ -108,11 +198,13 @@ def validate_user_data(data):
     if not data:
         return False, "No data provided"
 
-    required_fields = ["name", "phone_number"]
+    required_fields = USER_FIELDS
 
     for field in required_fields:
         if field not in data:
             return False, f"Missing required field: {field}"
+        if data[field] is None:
+            return False, f"Field cannot be null: {field}"
 
     return True, None
 
@@ -0,0 +1,50 @@
+from flask import request
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db
+from app.serializers import render, serialize
+
+# Helpers for optimistic concurrency on models with a version_id_col. The
+# version is exposed as the ETag and checked against If-Match; the UPDATE
+# itself also matches on the version, so a concurrent write is detected
+# even after the If-Match check passed. The ETag is weak since the same
+# version is served as JSON or MessagePack, compressed or not.
+
+
+# Validate a sparse PATCH payload against the fields that may be changed
+def validate_patch_data(data, allowed_fields):
+    if not data:
+        return False, "No data provided"
+
+    for field in data:
+        if field not in allowed_fields:
+            return False, f"Unknown or read-only field: {field}"
+        if data[field] is None:
+            return False, f"Field cannot be null: {field}"
+
+    return True, None
+
+
+# Return a 412 response if If-Match does not name the current version
+def check_if_match(obj):
+    if (request.if_match
+            and not request.if_match.contains_weak(str(obj.version))):
+        return render({"error": "Resource has been modified"}), 412
+    return None
+
+
+# Commit, returning a 412 response if another writer got there first
+def commit_or_conflict():
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return render({"error": "Resource has been modified"}), 412
+    return None
+
+
+def versioned_response(obj, status=200, fields=None):
+    response = render(serialize(obj, fields))
+    response.status_code = status
+    response.set_etag(str(obj.version), weak=True)
+    return response
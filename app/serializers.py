@@ -0,0 +1,158 @@
+import struct
+from datetime import datetime
+
+from flask import current_app, jsonify, request
+from sqlalchemy.orm import load_only
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Serializer registry shared by all models. Each model registers the fields
+# it exposes; ?fields= selects a subset of them, which is also pushed down
+# into the SELECT with load_only so unrequested columns are never loaded.
+# Responses are JSON, or MessagePack when the client asks for it in Accept.
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+RESPONSE_MIMETYPES = ['application/json', MSGPACK_MIMETYPE,
+                      'application/x-msgpack']
+
+# Columns loaded even when not requested, because the routes need them
+INTERNAL_FIELDS = ('id', 'is_deleted', 'version')
+
+_registry = {}
+
+
+def register(model, fields):
+    _registry[model] = tuple(fields)
+
+
+def fields_for(model):
+    return _registry[model]
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def serialize(obj, fields=None):
+    return {field: _value(getattr(obj, field))
+            for field in fields or _registry[type(obj)]}
+
+
+def serialize_many(objs, fields=None):
+    return [serialize(obj, fields) for obj in objs]
+
+
+# Parse ?fields=a,b into (fields, error_message); fields is None when absent
+def parse_fields(model, args):
+    requested = args.get('fields')
+    if requested is None:
+        return None, None
+
+    fields = [field.strip() for field in requested.split(',') if field.strip()]
+    if not fields:
+        return None, "No fields requested"
+    for field in fields:
+        if field not in _registry[model]:
+            return None, f"Unknown field: {field}"
+    return fields, None
+
+
+# Restrict the columns a query loads to the requested fields
+def project(query, model, fields, extra=()):
+    if fields is None:
+        return query
+
+    columns = model.__table__.columns
+    names = {*fields, *extra,
+             *(field for field in INTERNAL_FIELDS if field in columns)}
+    return query.options(load_only(*(getattr(model, name) for name in names)))
+
+
+# Render data as JSON or MessagePack depending on the Accept header, which
+# caches are told to key on
+def render(data):
+    mimetype = request.accept_mimetypes.best_match(RESPONSE_MIMETYPES)
+    if mimetype in (MSGPACK_MIMETYPE, 'application/x-msgpack'):
+        response = current_app.response_class(packb(data),
+                                              mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(data)
+    response.vary.add('Accept')
+    return response
+
+
+def packb(data):
+    if msgpack is not None:
+        return msgpack.packb(data)
+    out = []
+    _pack(data, out)
+    return b''.join(out)
+
+
+# Minimal MessagePack encoder used when the msgpack package is missing
+def _pack(obj, out):
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, int):
+        _pack_int(obj, out)
+    elif isinstance(obj, float):
+        out.append(b'\xcb' + struct.pack('>d', obj))
+    elif isinstance(obj, str):
+        encoded = obj.encode('utf-8')
+        _pack_header(len(encoded), out, 0xa0, 32, b'\xd9', b'\xda', b'\xdb')
+        out.append(encoded)
+    elif isinstance(obj, bytes):
+        _pack_header(len(obj), out, None, 0, b'\xc4', b'\xc5', b'\xc6')
+        out.append(obj)
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(len(obj), out, 0x90, 16, None, b'\xdc', b'\xdd')
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        _pack_header(len(obj), out, 0x80, 16, None, b'\xde', b'\xdf')
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"Cannot serialize {type(obj).__name__} to MessagePack")
+
+
+def _pack_header(length, out, fix_base, fix_limit, head8, head16, head32):
+    if fix_base is not None and length < fix_limit:
+        out.append(struct.pack('B', fix_base | length))
+    elif head8 is not None and length < 0x100:
+        out.append(head8 + struct.pack('B', length))
+    elif length < 0x10000:
+        out.append(head16 + struct.pack('>H', length))
+    else:
+        out.append(head32 + struct.pack('>I', length))
+
+
+def _pack_int(value, out):
+    if 0 <= value < 0x80 or -0x20 <= value < 0:
+        out.append(struct.pack('b' if value < 0 else 'B', value))
+    elif value >= 0:
+        for head, fmt, limit in ((b'\xcc', '>B', 0x100), (b'\xcd', '>H', 0x10000),
+                                 (b'\xce', '>I', 0x100000000),
+                                 (b'\xcf', '>Q', 0x10000000000000000)):
+            if value < limit:
+                out.append(head + struct.pack(fmt, value))
+                return
+        raise OverflowError("Integer too large for MessagePack")
+    else:
+        for head, fmt, limit in ((b'\xd0', '>b', 0x80), (b'\xd1', '>h', 0x8000),
+                                 (b'\xd2', '>i', 0x80000000),
+                                 (b'\xd3', '>q', 0x8000000000000000)):
+            if value >= -limit:
+                out.append(head + struct.pack(fmt, value))
+                return
+        raise OverflowError("Integer too large for MessagePack")
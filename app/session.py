@@ -0,0 +1,40 @@
+import sqlalchemy as sa
+from flask import current_app, g
+from flask_sqlalchemy.session import Session
+
+# Tables partitioned by shop_id. Everything else (users, categories and the
+# shop directory) stays on the default bind.
+SHARDED_TABLES = {
+    'shop', 'shop_hours', 'product', 'user_role',
+    'shop_archive', 'shop_hours_archive', 'product_archive',
+    'user_role_archive',
+}
+
+# Shard name of the default bind, which keeps the shops it held before
+# sharding was turned on until they are moved
+DEFAULT_SHARD = 'default'
+
+
+# Return the table a mapper or statement targets, if there is exactly one
+def _target_table(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table
+    if isinstance(clause, sa.Table):
+        return clause
+    return getattr(clause, 'table', None)
+
+
+# Session that sends shop-scoped tables to the shard selected with
+# app.sharding.use_shard, and everything else to the default bind
+
+
+class ShardedSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        shard = g.get('shard') if bind is None else None
+        if shard is not None and shard != DEFAULT_SHARD:
+            table = _target_table(mapper, clause)
+            if table is not None and table.name in SHARDED_TABLES:
+                return current_app.extensions['shard_engines'][shard]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
@@ -0,0 +1,326 @@
+import bisect
+import hashlib
+import time
+from contextlib import contextmanager
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, delete, func, insert, select
+
+from app import db
+from app.serializers import render
+from app.session import DEFAULT_SHARD
+from app.models import (Shop, ShopHours, Product, UserRole, ShopDirectory,
+                        ShardedId, ShopArchive, ShopHoursArchive, ProductArchive,
+                        UserRoleArchive)
+
+# Shop-scoped models and the column holding the shop id, parents first.
+# These are the rows copied when a shop moves between shards.
+SHOP_SCOPED_MODELS = [
+    (Shop, Shop.id),
+    (ShopHours, ShopHours.shop_id),
+    (Product, Product.shop_id),
+    (UserRole, UserRole.shop_id),
+    (ShopArchive, ShopArchive.id),
+    (ShopHoursArchive, ShopHoursArchive.shop_id),
+    (ProductArchive, ProductArchive.shop_id),
+    (UserRoleArchive, UserRoleArchive.shop_id),
+]
+
+DEFAULT_MOVE_DRAIN = 30
+
+# Consistent hash ring used to place new shops on a shard
+
+
+class HashRing:
+    def __init__(self, shards, replicas=64):
+        self._ring = sorted(
+            (self._hash(f"{shard}:{replica}"), shard)
+            for shard in shards for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def get(self, key):
+        index = bisect.bisect(self._hashes, self._hash(str(key)))
+        return self._ring[index % len(self._ring)][1]
+
+
+# Create one engine per shard URL and register the request hooks that route
+# shop-scoped requests. Shard engines are kept out of SQLALCHEMY_BINDS since
+# they share the default metadata instead of having their own.
+def init_app(app):
+    urls = app.config.get('SHARD_DATABASE_URLS') or []
+    engines = {f"shard{index}": create_engine(url)
+               for index, url in enumerate(urls)}
+
+    app.config['SHARD_BINDS'] = list(engines)
+    app.extensions['shard_engines'] = engines
+    app.extensions['shard_ring'] = HashRing(engines) if engines else None
+
+    # Seconds move_shop waits for writes routed before the move to finish;
+    # matches the default gunicorn worker timeout
+    app.config.setdefault('SHARD_MOVE_DRAIN', DEFAULT_MOVE_DRAIN)
+
+    app.before_request(_route_request)
+    app.teardown_request(_clear_shard)
+
+
+def is_enabled():
+    return bool(current_app.config['SHARD_BINDS'])
+
+
+# Bind keys to query, [None] (the default bind) when sharding is disabled.
+# With sharding enabled the default bind is queried too, for the shops it
+# held before sharding was turned on.
+def shard_keys():
+    if not is_enabled():
+        return [None]
+    return [DEFAULT_SHARD, *current_app.config['SHARD_BINDS']]
+
+
+# Return the shard holding shop_id, or None when sharding is disabled
+def shard_for(shop_id):
+    if not is_enabled():
+        return None
+
+    directory = db.session.get(ShopDirectory, shop_id)
+    if directory is None:
+        return current_app.extensions['shard_ring'].get(shop_id)
+    return directory.shard
+
+
+# Send shop-scoped queries made inside the block to the given shard
+@contextmanager
+def use_shard(shard):
+    previous = g.get('shard')
+    g.shard = shard
+    try:
+        yield
+    finally:
+        g.shard = previous
+
+
+# Run query on every shard and concatenate the results
+def scatter(query):
+    results = []
+    for shard in shard_keys():
+        with use_shard(shard):
+            results.extend(query())
+    return results
+
+
+# Give a new shop a globally unique id and return the shard it belongs on
+def allocate_shop(shop):
+    if not is_enabled():
+        return None
+
+    directory = ShopDirectory(shard='')
+    db.session.add(directory)
+    db.session.flush()
+    directory.shard = current_app.extensions['shard_ring'].get(
+        directory.shop_id)
+    shop.id = directory.shop_id
+    return directory.shard
+
+
+def _next_id(table_name):
+    allocation = ShardedId(table_name=table_name)
+    db.session.add(allocation)
+    db.session.flush()
+    return allocation.id
+
+
+# Give a new shop hours, product or user role row an id that is unique across
+# shards. Call it before adding the row to the session.
+def allocate_id(row):
+    if is_enabled():
+        row.id = _next_id(row.__tablename__)
+
+
+def _moving_response():
+    return (render({"error": "Shop is being moved, try again shortly"}),
+            503, {"Retry-After": "1"})
+
+
+# Return a 503 response while shop_id is being moved, or None. Writes to
+# shop-scoped rows of a shop not named in the URL must call this themselves.
+def check_not_moving(shop_id):
+    if not is_enabled():
+        return None
+
+    directory = db.session.get(ShopDirectory, shop_id)
+    if directory is not None and directory.is_moving:
+        return _moving_response()
+    return None
+
+
+def _route_request():
+    shop_id = (request.view_args or {}).get('shop_id')
+    if shop_id is None or not is_enabled():
+        return None
+
+    directory = db.session.get(ShopDirectory, shop_id)
+    if directory is None:
+        return None
+    if directory.is_moving and request.method != 'GET':
+        return _moving_response()
+    g.shard = directory.shard
+    return None
+
+
+def _clear_shard(exc):
+    g.pop('shard', None)
+
+
+# Create the schema on every shard. Foreign keys to tables on the default
+# bind (user, category) are not enforced across databases.
+def create_all():
+    for engine in current_app.extensions['shard_engines'].values():
+        db.metadata.create_all(engine)
+
+
+def _row_to_dict(row):
+    return {column.name: getattr(row, column.name)
+            for column in row.__table__.columns}
+
+
+# Rows created before ids were allocated globally can clash with rows already
+# on the target shard; those get a fresh id. Must run on the target shard.
+def _remap_clashing_ids(model, rows):
+    clashing = set(db.session.scalars(select(model.id).where(
+        model.id.in_([row['id'] for row in rows]))))
+    for row in rows:
+        if row['id'] in clashing:
+            row['id'] = _next_id(model.__tablename__)
+
+
+def _delete_shop_rows(shop_id, shard):
+    with use_shard(shard):
+        for model, shop_column in reversed(SHOP_SCOPED_MODELS):
+            db.session.execute(
+                delete(model).where(shop_column == shop_id)
+                .execution_options(synchronize_session=False))
+
+
+# Move a shop and all its rows to another shard. Reads keep being served from
+# the source shard until the directory flips; writes get a 503 meanwhile.
+def move_shop(shop_id, target):
+    if target not in current_app.config['SHARD_BINDS']:
+        raise ValueError(f"Unknown shard: {target}")
+
+    directory = db.session.get(ShopDirectory, shop_id)
+    if directory is None:
+        raise ValueError(f"Unknown shop: {shop_id}")
+
+    source = directory.shard
+    if source == target:
+        return
+
+    directory.is_moving = True
+    db.session.commit()
+
+    # Writes routed to the source before is_moving was set may still be
+    # running. Let them finish (or their worker time out) before copying, or
+    # they would commit to the source after it was read and be lost.
+    time.sleep(current_app.config['SHARD_MOVE_DRAIN'])
+
+    try:
+        for model, shop_column in SHOP_SCOPED_MODELS:
+            with use_shard(source):
+                rows = [_row_to_dict(row) for row in db.session.scalars(
+                    select(model).where(shop_column == shop_id))]
+            if rows:
+                with use_shard(target):
+                    if shop_column is not model.id:
+                        _remap_clashing_ids(model, rows)
+                    db.session.execute(insert(model), rows)
+
+        # The copy and the directory flip are on different databases and
+        # commit one after the other. The copy goes first; if the flip then
+        # fails, the copied rows are removed and the source stays in use.
+        db.session.commit()
+        try:
+            directory.shard = target
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            _delete_shop_rows(shop_id, target)
+            db.session.commit()
+            raise
+
+        # The source rows are only removed once the shop is served from the
+        # target
+        _delete_shop_rows(shop_id, source)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        directory = db.session.get(ShopDirectory, shop_id)
+        directory.is_moving = False
+        db.session.commit()
+        db.session.expunge_all()
+
+
+def _max_id(models):
+    return max(db.session.scalar(select(func.max(model.id))) or 0
+               for model in models)
+
+
+# Register the shops of a database that predates sharding in the directory,
+# on the default bind under their current ids, and start the shop and child
+# id sequences above the ids already used. Safe to run again.
+def register_existing_shops():
+    with use_shard(DEFAULT_SHARD):
+        shop_ids = set(db.session.scalars(select(Shop.id)))
+        shop_ids.update(db.session.scalars(select(ShopArchive.id)))
+        child_max_id = _max_id([ShopHours, Product, UserRole,
+                                ShopHoursArchive, ProductArchive,
+                                UserRoleArchive])
+
+    registered = set(db.session.scalars(
+        select(ShopDirectory.shop_id).where(
+            ShopDirectory.shop_id.in_(shop_ids))))
+    new_ids = sorted(shop_ids - registered)
+    db.session.add_all([ShopDirectory(shop_id=shop_id, shard=DEFAULT_SHARD)
+                        for shop_id in new_ids])
+
+    # Inserting the highest id moves the autoincrement past it
+    if child_max_id > _max_id([ShardedId]):
+        db.session.add(ShardedId(id=child_max_id, table_name='reserved'))
+    db.session.commit()
+    return len(new_ids)
+
+
+# CLI entry point: flask register-shops
+@click.command('register-shops')
+@with_appcontext
+def register_shops_command():
+    registered = register_existing_shops()
+    click.echo(f"Registered {registered} shops on the default bind")
+
+
+# CLI entry point: flask create-shards
+@click.command('create-shards')
+@with_appcontext
+def create_shards_command():
+    create_all()
+    click.echo(f"Created {len(current_app.config['SHARD_BINDS'])} shards")
+
+
+# CLI entry point: flask move-shop <shop_id> <shard>
+@click.command('move-shop')
+@click.argument('shop_id', type=int)
+@click.argument('shard')
+@with_appcontext
+def move_shop_command(shop_id, shard):
+    try:
+        move_shop(shop_id, shard)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Moved shop {shop_id} to {shard}")
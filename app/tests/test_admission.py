@@ -0,0 +1,142 @@
+import os
+import time
+
+import pytest
+from app import create_app, db, admission
+
+
+@pytest.fixture
+def settings():
+    return {'queue_target': 0.005, 'queue_interval': 0.1,
+            **admission.DEFAULT_SETTINGS['read']}
+
+
+@pytest.fixture
+def state(tmp_path):
+    shared_state = admission.SharedState(
+        os.path.join(tmp_path, "admission.db"), len(admission.ROUTE_CLASSES))
+    yield shared_state
+    shared_state.close()
+
+
+def make_client(tmp_path, limits):
+    app = create_app(testing=True, config={
+        'ADMISSION_ENABLED': True,
+        'ADMISSION_STATE_FILE': os.path.join(tmp_path, "admission.db"),
+        'ADMISSION_LIMITS': limits,
+    })
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+    return app.test_client()
+
+
+# Test that the concurrency limit rejects requests once full
+def test_concurrency_limit(state, settings):
+    settings['initial_limit'] = 2
+    now = time.time()
+
+    assert admission.admit(state, 0, settings, None, now) is None
+    assert admission.admit(state, 0, settings, None, now) is None
+    assert admission.admit(state, 0, settings, None, now) == (503, 1)
+
+    admission.release(state, 0, settings, 0.01, now)
+    assert admission.admit(state, 0, settings, None, now) is None
+
+
+# Test that the limit backs off on slow requests and grows on fast ones
+def test_aimd_limit(state, settings):
+    now = time.time()
+    admission.admit(state, 0, settings, None, now)
+    admission.release(state, 0, settings, 10.0, now)
+    with state.locked(0) as values:
+        assert values[admission.LIMIT] == settings['initial_limit'] * 0.9
+
+    admission.admit(state, 0, settings, None, now)
+    admission.release(state, 0, settings, 0.01, now)
+    with state.locked(0) as values:
+        assert values[admission.LIMIT] > settings['initial_limit'] * 0.9
+        assert values[admission.INFLIGHT] == 0
+
+
+# Test that slots held by a worker that died mid-request are given back
+def test_reap_dead_worker(state, settings):
+    settings['initial_limit'] = 2
+    now = time.time()
+    assert admission.admit(state, 0, settings, None, now) is None
+
+    # A worker admits a request and is killed before releasing it
+    pid = os.fork()
+    if pid == 0:
+        admission.admit(state, 0, settings, None, now)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert admission.admit(state, 0, settings, None, now) == (503, 1)
+
+    assert state.reap() == 1
+    with state.locked(0) as values:
+        assert values[admission.INFLIGHT] == 1
+    assert admission.admit(state, 0, settings, None, now) is None
+
+
+# Test that a burst of slow requests backs off only once
+def test_aimd_backoff_once_per_window(state, settings):
+    now = time.time()
+    for _ in range(5):
+        admission.admit(state, 0, settings, None, now)
+    for _ in range(5):
+        admission.release(state, 0, settings, 1.0, now + 1.0)
+    with state.locked(0) as values:
+        assert values[admission.LIMIT] == settings['initial_limit'] * 0.9
+
+    # A slow request admitted after the decrease backs off again
+    admission.admit(state, 0, settings, None, now + 1.5)
+    admission.release(state, 0, settings, 1.0, now + 2.5)
+    with state.locked(0) as values:
+        assert values[admission.LIMIT] == pytest.approx(
+            settings['initial_limit'] * 0.81)
+
+
+# Test that requests are shed once the queueing delay stays above target
+def test_codel_queue_delay(state, settings):
+    now = time.time()
+    assert admission.admit(state, 0, settings, 0.5, now) is None
+    assert admission.admit(state, 0, settings, 0.5, now + 0.2) == (503, 1)
+    assert admission.admit(state, 0, settings, 0.001, now + 0.3) is None
+
+
+# Test that an empty token bucket answers 429 with Retry-After
+def test_token_bucket_route(tmp_path):
+    test_client = make_client(
+        tmp_path, {'bulk': {'rate': 0.5, 'burst': 1}})
+
+    assert test_client.get("/shops/").status_code == 200
+    response = test_client.get("/shops/")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+    # Other route classes have their own state
+    assert test_client.get("/shops/1").status_code == 404
+
+    # Rejections are negotiated like every other response
+    response = test_client.get("/shops/",
+                               headers={"Accept": "application/msgpack"})
+    assert response.status_code == 429
+    assert response.mimetype == "application/msgpack"
+
+
+# Test that a rate without a burst gets a default burst
+def test_token_bucket_default_burst(tmp_path):
+    test_client = make_client(tmp_path, {'bulk': {'rate': 2}})
+
+    assert test_client.get("/shops/").status_code == 200
+    assert test_client.get("/shops/").status_code == 200
+    assert test_client.get("/shops/").status_code == 429
+
+
+# Test that in-flight counts are released after each request
+def test_inflight_released(tmp_path):
+    test_client = make_client(tmp_path, {'read': {'initial_limit': 1}})
+
+    for _ in range(3):
+        assert test_client.get("/users/1").status_code == 404
@@ -0,0 +1,110 @@
+import gzip
+
+import pytest
+from flask import Response
+from app import create_app, db, compression
+from app.models import Shop
+
+
+@pytest.fixture
+def test_app():
+    app = create_app(testing=True)
+    app.config['TESTING'] = True
+
+    @app.route('/stream')
+    def stream():
+        return Response((f"line {index}\n" for index in range(100)),
+                        mimetype='text/plain')
+
+    app_context = app.app_context()
+    app_context.push()
+
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            Shop(name=f"Test Shop {index}", latitude=10.0, longitude=10.0,
+                 phone_number="1234567890")
+            for index in range(20)
+        ])
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    app_context.pop()
+
+
+@pytest.fixture
+def test_client(test_app):
+    return test_app.test_client()
+
+
+# Test that large JSON responses are gzipped when the client accepts it
+def test_gzip_negotiated(test_client):
+    plain = test_client.get("/shops/")
+    response = test_client.get("/shops/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+    assert len(response.get_data()) < len(plain.get_data())
+
+
+# Test that identity is served when nothing acceptable is offered
+def test_no_compression(test_client):
+    response = test_client.get("/shops/")
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    response = test_client.get("/shops/", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in response.headers
+
+    # Small bodies are not worth compressing
+    response = test_client.get("/shops/1", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+# Test that repeated hits are served from the precompressed cache
+def test_precompressed_cache(test_client, monkeypatch):
+    calls = []
+    original = compression.compress
+
+    def counting_compress(body, encoding):
+        calls.append(encoding)
+        return original(body, encoding)
+    monkeypatch.setattr(compression, "compress", counting_compress)
+
+    first = test_client.get("/shops/", headers={"Accept-Encoding": "gzip"})
+    second = test_client.get("/shops/", headers={"Accept-Encoding": "gzip"})
+
+    assert calls == ["gzip"]
+    assert first.get_data() == second.get_data()
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert first.headers["ETag"].endswith('-gzip"')
+
+
+# Test that streamed responses are compressed chunk by chunk
+def test_streaming_compression(test_client):
+    response = test_client.get("/stream", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in response.headers
+    expected = "".join(f"line {index}\n" for index in range(100))
+    assert gzip.decompress(response.get_data()).decode() == expected
+
+
+# Test that the cache evicts least recently used bodies past its size
+def test_precompressed_cache_eviction():
+    cache = compression.PrecompressedCache(max_bytes=10)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    cache.get("a")
+    cache.put("c", b"12345")
+
+    assert cache.get("a") == b"12345"
+    assert cache.get("b") is None
+    assert cache.get("c") == b"12345"
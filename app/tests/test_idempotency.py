@@ -0,0 +1,137 @@
+from datetime import timedelta
+
+import pytest
+from app import create_app, db, idempotency
+from app.models import Shop, User, IdempotencyKey
+
+
+@pytest.fixture
+def test_app():
+    app = create_app(testing=True, config={'IDEMPOTENCY_WAIT': 0.1})
+    app.config['TESTING'] = True
+    app_context = app.app_context()
+    app_context.push()
+
+    with app.app_context():
+        db.create_all()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    app_context.pop()
+
+
+@pytest.fixture
+def test_client(test_app):
+    return test_app.test_client()
+
+
+SHOP_DATA = {
+    "name": "Test Shop",
+    "latitude": 10.0,
+    "longitude": 10.0,
+    "phone_number": "1234567890",
+}
+
+
+# Test that a retried create is replayed instead of inserting again
+def test_replay_create_shop(test_client):
+    headers = {"Idempotency-Key": "create-shop-1"}
+    first = test_client.post("/shops/", json=SHOP_DATA, headers=headers)
+    second = test_client.post("/shops/", json=SHOP_DATA, headers=headers)
+
+    assert first.status_code == 201
+    assert second.status_code == 201
+    assert second.get_json() == first.get_json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert Shop.query.count() == 1
+
+    # Without a key every request creates a shop
+    test_client.post("/shops/", json=SHOP_DATA)
+    assert Shop.query.count() == 2
+
+
+# Test that reusing a key for a different request is rejected
+def test_key_reused_for_other_request(test_client):
+    headers = {"Idempotency-Key": "create-user-1"}
+    test_client.post("/users/", json={"name": "A", "phone_number": "1"},
+                     headers=headers)
+    response = test_client.post("/users/", json={"name": "B", "phone_number": "2"},
+                                headers=headers)
+
+    assert response.status_code == 422
+    assert User.query.count() == 1
+
+    response = test_client.post("/users/", json={"name": "B", "phone_number": "2"},
+                                headers={**headers,
+                                         "Accept": "application/msgpack"})
+    assert response.status_code == 422
+    assert response.mimetype == "application/msgpack"
+
+
+# Test that a duplicate waits for the first request and gives up with 409
+def test_duplicate_in_progress(test_client):
+    test_client.post("/shops/", json=SHOP_DATA,
+                     headers={"Idempotency-Key": "first"})
+    record = db.session.get(IdempotencyKey, "first")
+    db.session.add(IdempotencyKey(key="in-progress",
+                                  fingerprint=record.fingerprint,
+                                  expires_at=record.expires_at,
+                                  locked_until=record.locked_until))
+    db.session.commit()
+
+    response = test_client.post("/shops/", json=SHOP_DATA,
+                                headers={"Idempotency-Key": "in-progress"})
+
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert Shop.query.count() == 1
+
+
+# Test that a claim left by a dead worker is taken over once its lease ends
+def test_expired_lease_taken_over(test_client):
+    test_client.post("/shops/", json=SHOP_DATA,
+                     headers={"Idempotency-Key": "first"})
+    record = db.session.get(IdempotencyKey, "first")
+    db.session.add(IdempotencyKey(
+        key="abandoned", fingerprint=record.fingerprint,
+        expires_at=record.expires_at,
+        locked_until=idempotency._utcnow() - timedelta(seconds=1)))
+    db.session.commit()
+
+    headers = {"Idempotency-Key": "abandoned"}
+    first = test_client.post("/shops/", json=SHOP_DATA, headers=headers)
+    second = test_client.post("/shops/", json=SHOP_DATA, headers=headers)
+
+    assert first.status_code == 201
+    assert "Idempotent-Replayed" not in first.headers
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert Shop.query.count() == 2
+
+
+# Test that expired keys no longer replay
+def test_expired_key(test_client):
+    headers = {"Idempotency-Key": "create-shop-2"}
+    test_client.post("/shops/", json=SHOP_DATA, headers=headers)
+    record = db.session.get(IdempotencyKey, "create-shop-2")
+    record.expires_at = idempotency._utcnow() - timedelta(seconds=1)
+    db.session.commit()
+
+    response = test_client.post("/shops/", json=SHOP_DATA, headers=headers)
+
+    assert "Idempotent-Replayed" not in response.headers
+    assert Shop.query.count() == 2
+
+
+# Test that validation errors are replayed too
+def test_error_responses(test_client):
+    headers = {"Idempotency-Key": "invalid-category"}
+    first = test_client.post("/shops/categories", json={}, headers=headers)
+    second = test_client.post("/shops/categories", json={}, headers=headers)
+
+    assert first.status_code == 400
+    assert second.status_code == 400
+    assert second.headers["Idempotent-Replayed"] == "true"
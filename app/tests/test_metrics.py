@@ -0,0 +1,83 @@
+import os
+
+import pytest
+from app import create_app, db, metrics
+
+
+@pytest.fixture
+def test_app(tmp_path):
+    app = create_app(testing=True, config={'METRICS_DIR': str(tmp_path)})
+    app.config['TESTING'] = True
+    app_context = app.app_context()
+    app_context.push()
+
+    with app.app_context():
+        db.create_all()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    app_context.pop()
+
+
+@pytest.fixture
+def test_client(test_app):
+    return test_app.test_client()
+
+
+# Test that requests are counted and timed per endpoint
+def test_metrics_endpoint(test_client):
+    test_client.get("/shops/")
+    test_client.get("/shops/")
+    test_client.get("/users/1")
+
+    response = test_client.get("/metrics")
+    body = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    assert ('http_requests_total{endpoint="shop.get_shops",method="GET",'
+            'status="200"} 2.0') in body
+    assert ('http_requests_total{endpoint="user.get_user",method="GET",'
+            'status="404"} 1.0') in body
+    assert ('http_request_duration_seconds_bucket{endpoint="shop.get_shops",'
+            'le="+Inf"} 2.0') in body
+    assert 'http_response_size_bytes_count{endpoint="shop.get_shops"} 2.0' in body
+    assert 'db_query_duration_seconds_count{endpoint="shop.get_shops"} 2.0' in body
+
+
+# Test that samples written by other worker processes are summed
+def test_metrics_aggregated_across_processes(test_app, tmp_path):
+    directory = str(tmp_path)
+    labels = (("endpoint", "shop.get_shops"), ("method", "GET"),
+              ("status", "200"))
+    metrics.inc(directory, "http_requests_total", labels, 3.0)
+
+    other_worker = metrics.MmapValues(
+        os.path.join(directory, "metrics_999999.db"))
+    other_worker.add(metrics._key("http_requests_total", "", labels), 4.0)
+    other_worker.close()
+
+    samples = metrics.collect(directory)
+    assert samples[("http_requests_total", "", labels)] == 7.0
+
+
+# Test that a store reopened from its file keeps its values
+def test_mmap_values_reopen(tmp_path):
+    path = os.path.join(tmp_path, "metrics_1.db")
+    values = metrics.MmapValues(path)
+    for index in range(5000):
+        values.add(f"key-{index}", index)
+    values.close()
+
+    values = metrics.MmapValues(path)
+    values.add("key-10", 1.0)
+    values.close()
+
+    stored = dict(metrics._read_file(path))
+    assert len(stored) == 5000
+    assert stored["key-10"] == 11.0
+    assert stored["key-4999"] == 4999.0
@@ -0,0 +1,51 @@
+import gc
+
+import pytest
+from app import create_app, db, preload
+
+
+# Warm-up disposes the engines, so use a database that outlives its pool
+@pytest.fixture
+def test_app(tmp_path):
+    app = create_app(testing=True, config={
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'test.db'}"})
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all()
+
+    yield app
+
+    gc.unfreeze()
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+# Test that warm-up fills the compiled cache and freezes the heap
+def test_warm_up(test_app):
+    preload.warm_up(test_app, started_at=0.0, import_times={"flask": 0.1})
+
+    with test_app.app_context():
+        assert len(db.engine._compiled_cache) > 0
+    assert gc.get_freeze_count() > 0
+
+    report = test_app.extensions['startup_report']
+    assert report['imports'] == {"flask": 0.1}
+    assert report['warm_up'] > 0
+
+
+# Test that the first request after fork is reported at /startup
+def test_startup_report(test_app):
+    preload.warm_up(test_app)
+    preload.post_fork(test_app)
+    test_client = test_app.test_client()
+    test_client.get("/shops/")
+    first_request = test_app.extensions['startup_report']['first_request']
+    test_client.get("/shops/")
+
+    response = test_client.get("/startup")
+    report = response.get_json()
+
+    assert response.status_code == 200
+    assert report['first_request'] == first_request
+    assert 'worker_started_at' not in report
@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import pytest
+from app import create_app, db, profiling
+
+
+def make_app(tmp_path, **config):
+    app = create_app(testing=True, config={
+        'SECRET_KEY': 'test',
+        'PROFILING_ENABLED': True,
+        'PROFILE_DIR': str(tmp_path),
+        'PROFILE_INTERVAL': 0.001,
+        **config,
+    })
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def test_app(tmp_path):
+    app = make_app(tmp_path)
+    app_context = app.app_context()
+    app_context.push()
+
+    with app.app_context():
+        db.create_all()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    app_context.pop()
+
+
+@pytest.fixture
+def test_client(test_app):
+    return test_app.test_client()
+
+
+# Test that only requests with a valid signed header are profiled
+def test_profile_signed_header(test_app, test_client, tmp_path):
+    test_client.get("/shops/")
+    test_client.get("/shops/", headers={"X-Profile": "forged"})
+    assert os.listdir(tmp_path) == []
+
+    token = profiling.make_token(test_app)
+    test_client.get("/shops/", headers={"X-Profile": token})
+
+    response = test_client.get("/profiles", headers={"X-Profile": token})
+    profiles = response.get_json()
+    assert response.status_code == 200
+    assert len(profiles) == 1
+    assert profiles[0]["endpoint"] == "shop.get_shops"
+
+    response = test_client.get(f"/profiles/{profiles[0]['name']}",
+                               headers={"X-Profile": token})
+    assert response.status_code == 200
+    assert len(os.listdir(tmp_path)) == 1
+
+
+# Test that profiles can only be read with a valid signed header
+def test_profiles_require_token(test_app, test_client, tmp_path):
+    token = profiling.make_token(test_app)
+    test_client.get("/shops/", headers={"X-Profile": token})
+    name = os.listdir(tmp_path)[0]
+
+    assert test_client.get("/profiles").status_code == 403
+    assert test_client.get(f"/profiles/{name}").status_code == 403
+    response = test_client.get("/profiles", headers={"X-Profile": "forged"})
+    assert response.status_code == 403
+
+
+# Test that the latency threshold keeps only slow requests
+def test_profile_latency_threshold(tmp_path):
+    app = make_app(tmp_path, PROFILE_LATENCY_THRESHOLD=0.05)
+
+    @app.route('/slow')
+    def slow():
+        time.sleep(0.1)
+        return "done"
+
+    with app.app_context():
+        db.create_all()
+        test_client = app.test_client()
+        test_client.get("/shops/")
+        test_client.get("/slow")
+
+    names = os.listdir(tmp_path)
+    assert len(names) == 1
+    assert "_slow_" in names[0]
+    with open(os.path.join(tmp_path, names[0])) as profile_file:
+        assert "slow (test_profiling.py" in profile_file.read()
+
+
+# Test that a disabled profiler registers no hooks or endpoints
+def test_profiling_disabled(tmp_path):
+    app = make_app(tmp_path, PROFILING_ENABLED=False)
+
+    assert 'profiler' not in app.extensions
+    assert 'list_profiles' not in app.view_functions
+
+
+# Test that the sampler records collapsed stacks of a busy thread
+def test_sampler_collapsed_stacks():
+    sampler = profiling.Sampler(0.001)
+    done = threading.Event()
+
+    def busy_worker():
+        done.wait(1)
+
+    thread = threading.Thread(target=busy_worker)
+    thread.start()
+    sampler.start(thread.ident)
+    time.sleep(0.05)
+    counts = sampler.stop(thread.ident)
+    done.set()
+    thread.join()
+
+    assert counts
+    assert all(stack.split(";")[-1].startswith("wait (")
+               for stack in counts)
+    assert any("busy_worker (test_profiling.py" in stack for stack in counts)
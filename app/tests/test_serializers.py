@@ -0,0 +1,100 @@
+import pytest
+from sqlalchemy import event
+from app import create_app, db, serializers
+from app.models import Shop, User
+
+
+@pytest.fixture
+def test_app():
+    app = create_app(testing=True)
+    app.config['TESTING'] = True
+    app_context = app.app_context()
+    app_context.push()
+
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([
+            Shop(name="Test Shop", latitude=10.0, longitude=20.0,
+                 phone_number="1234567890"),
+            User(name="A", phone_number="1"),
+        ])
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    app_context.pop()
+
+
+@pytest.fixture
+def test_client(test_app):
+    return test_app.test_client()
+
+
+@pytest.fixture
+def statements(test_app):
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        captured.append(statement)
+    event.listen(db.engine, "before_cursor_execute", capture)
+    yield captured
+    event.remove(db.engine, "before_cursor_execute", capture)
+
+
+# Test that ?fields= limits both the response and the SELECT
+def test_sparse_fieldset(test_client, statements):
+    response = test_client.get("/shops/?fields=id,name")
+
+    assert response.status_code == 200
+    assert response.get_json() == [{"id": 1, "name": "Test Shop"}]
+    select = [statement for statement in statements
+              if statement.startswith("SELECT")][-1]
+    assert "shop.name" in select
+    assert "shop.latitude" not in select
+    assert "shop.phone_number" not in select
+
+
+# Test that unknown fields are rejected
+def test_unknown_field(test_client):
+    response = test_client.get("/users/1?fields=id,phone_normalized")
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Unknown field: phone_normalized"
+
+
+# Test that MessagePack is served when the client asks for it
+def test_msgpack_negotiation(test_client):
+    response = test_client.get("/users/1?fields=id,name",
+                               headers={"Accept": "application/msgpack"})
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/msgpack"
+    assert response.get_data() == b"\x82\xa2id\x01\xa4name\xa1A"
+    assert "Accept" in response.vary
+
+    response = test_client.get("/users/1?fields=id,name",
+                               headers={"Accept": "application/json"})
+    assert response.get_json() == {"id": 1, "name": "A"}
+    assert "Accept" in response.vary
+
+
+# Test the fallback MessagePack encoder against known encodings
+@pytest.mark.parametrize("value, encoded", [
+    (None, b"\xc0"),
+    (True, b"\xc3"),
+    (-1, b"\xff"),
+    (200, b"\xcc\xc8"),
+    (-200, b"\xd1\xff\x38"),
+    (70000, b"\xce\x00\x01\x11\x70"),
+    (1.5, b"\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00"),
+    ("a" * 40, b"\xd9\x28" + b"a" * 40),
+    ([1, 2], b"\x92\x01\x02"),
+    ({"a": [1]}, b"\x81\xa1a\x91\x01"),
+])
+def test_fallback_packb(value, encoded):
+    out = []
+    serializers._pack(value, out)
+    assert b"".join(out) == encoded
@@ -0,0 +1,314 @@
+import pytest
+from app import create_app, db, sharding
+from app.archive import archive_deleted_shops, archive_deleted_users
+from app.models import (Shop, Product, Category, ShopDirectory, User,
+                        UserRole, ShopArchive)
+from app.session import DEFAULT_SHARD
+
+
+@pytest.fixture
+def test_app(tmp_path):
+    shard_urls = [f"sqlite:///{tmp_path / f'shard{index}.db'}"
+                  for index in range(3)]
+    app = create_app(testing=True, config={
+                     'SHARD_DATABASE_URLS': shard_urls,
+                     'SHARD_MOVE_DRAIN': 0})
+    app.config['TESTING'] = True
+    app_context = app.app_context()
+    app_context.push()
+
+    with app.app_context():
+        db.create_all()
+        sharding.create_all()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+    app_context.pop()
+
+
+@pytest.fixture
+def test_client(test_app):
+    return test_app.test_client()
+
+
+def create_shops(test_client, count):
+    shop_ids = []
+    for index in range(count):
+        data = {
+            "name": f"Test Shop {index}",
+            "latitude": 10.0,
+            "longitude": 10.0,
+            "phone_number": "1234567890",
+        }
+        response = test_client.post("/shops/", json=data)
+        assert response.status_code == 201
+        shop_ids.append(response.get_json()["id"])
+    return shop_ids
+
+
+def count_on_shard(model, shard):
+    with sharding.use_shard(shard):
+        return model.query.count()
+
+
+# Test that shops are spread over the shards and gathered back by get_shops
+def test_get_shops_scatter_gather(test_client):
+    shop_ids = create_shops(test_client, 12)
+
+    assert len(set(shop_ids)) == 12
+    counts = [count_on_shard(Shop, shard) for shard in sharding.shard_keys()]
+    assert sum(counts) == 12
+    assert len([count for count in counts if count]) > 1
+
+    response = test_client.get("/shops/")
+    json_data = response.get_json()
+
+    assert response.status_code == 200
+    assert [shop["id"] for shop in json_data] == sorted(shop_ids)
+
+
+# Test that shop-scoped writes and reads go to the shop's shard
+def test_products_routed_to_shop_shard(test_client):
+    shop_id = create_shops(test_client, 1)[0]
+    category = Category(name="Test Category")
+    db.session.add(category)
+    db.session.commit()
+
+    data = {
+        "category_id": category.id,
+        "name": "Test Product",
+        "amount": 100,
+        "price": 9.99,
+    }
+    response = test_client.post(f"/shops/{shop_id}/products", json=data)
+    assert response.status_code == 201
+
+    shard = sharding.shard_for(shop_id)
+    assert count_on_shard(Product, shard) == 1
+    for other_shard in sharding.shard_keys():
+        if other_shard != shard:
+            assert count_on_shard(Product, other_shard) == 0
+
+    response = test_client.get(f"/shops/{shop_id}/products")
+    assert response.status_code == 200
+    assert response.get_json()[0]["name"] == "Test Product"
+
+
+# Test that user roles are stored on the shard of their shop
+def test_modify_user_role_on_shop_shard(test_client):
+    shop_id = create_shops(test_client, 1)[0]
+    user = User(name="Test User", phone_number="1234567890")
+    db.session.add(user)
+    db.session.commit()
+
+    response = test_client.put(f"/users/{user.id}/roles",
+                               json={"shop_id": shop_id, "role": "admin"})
+    assert response.status_code == 200
+    assert count_on_shard(UserRole, sharding.shard_for(shop_id)) == 1
+
+
+# Test moving a shop and its products to another shard
+def test_move_shop(test_client):
+    shop_id = create_shops(test_client, 1)[0]
+    category = Category(name="Test Category")
+    db.session.add(category)
+    db.session.commit()
+    data = {
+        "category_id": category.id,
+        "name": "Test Product",
+        "amount": 100,
+        "price": 9.99,
+    }
+    test_client.post(f"/shops/{shop_id}/products", json=data)
+
+    source = sharding.shard_for(shop_id)
+    target = next(shard for shard in test_client.application.config[
+        'SHARD_BINDS'] if shard != source)
+    sharding.move_shop(shop_id, target)
+
+    assert sharding.shard_for(shop_id) == target
+    assert not db.session.get(ShopDirectory, shop_id).is_moving
+    assert count_on_shard(Shop, source) == 0
+    assert count_on_shard(Product, source) == 0
+
+    response = test_client.get(f"/shops/{shop_id}/products")
+    assert response.status_code == 200
+    assert response.get_json()[0]["name"] == "Test Product"
+
+
+# Test that child rows get ids unique across shards, and that moving a shop
+# onto a shard already holding children does not clash with them
+def test_move_shop_onto_shard_with_children(test_client):
+    shop_ids = create_shops(test_client, 12)
+    source_shop = shop_ids[0]
+    source = sharding.shard_for(source_shop)
+    target_shop = next(shop_id for shop_id in shop_ids
+                       if sharding.shard_for(shop_id) != source)
+    target = sharding.shard_for(target_shop)
+    category = Category(name="Test Category")
+    db.session.add(category)
+    db.session.commit()
+
+    product_ids = []
+    for shop_id in [source_shop, target_shop]:
+        data = {
+            "category_id": category.id,
+            "name": f"Test Product {shop_id}",
+            "amount": 100,
+            "price": 9.99,
+        }
+        response = test_client.post(f"/shops/{shop_id}/products", json=data)
+        product_ids.append(response.get_json()["id"])
+    assert product_ids[0] != product_ids[1]
+
+    # A row created before global ids, clashing with the moving product
+    with sharding.use_shard(target):
+        db.session.add(Product(id=product_ids[0], shop_id=target_shop,
+                               category_id=category.id, name="Old Product",
+                               amount=1, price=1.0))
+        db.session.commit()
+
+    sharding.move_shop(source_shop, target)
+
+    assert count_on_shard(Product, target) == 3
+    response = test_client.get(f"/shops/{source_shop}/products")
+    moved = response.get_json()
+    assert [product["name"] for product in moved] == [
+        f"Test Product {source_shop}"]
+    assert moved[0]["id"] not in product_ids
+
+
+# Test that writes to a shop are rejected while it is being moved
+def test_write_rejected_while_moving(test_client):
+    shop_id = create_shops(test_client, 1)[0]
+    directory = db.session.get(ShopDirectory, shop_id)
+    directory.is_moving = True
+    db.session.commit()
+
+    response = test_client.delete(f"/shops/{shop_id}")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    response = test_client.get(f"/shops/{shop_id}")
+    assert response.status_code == 200
+
+    # Roles are shop-scoped too, though the shop is not in their URL
+    user = User(name="Test User", phone_number="1234567890")
+    db.session.add(user)
+    db.session.commit()
+    response = test_client.put(f"/users/{user.id}/roles",
+                               json={"shop_id": shop_id, "role": "admin"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+# Test that archival runs on every shard
+def test_archive_deleted_shops_on_shards(test_client):
+    shop_ids = create_shops(test_client, 6)
+    for shop_id in shop_ids:
+        assert test_client.delete(f"/shops/{shop_id}").status_code == 200
+
+    assert archive_deleted_shops() == 6
+    assert sum(count_on_shard(ShopArchive, shard)
+               for shard in sharding.shard_keys()) == 6
+
+    response = test_client.get(f"/shops/archived/{shop_ids[0]}")
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "Test Shop 0"
+
+
+# Test that archived roles are gathered from every shard
+def test_get_archived_user_roles_on_shards(test_client):
+    shop_id = create_shops(test_client, 1)[0]
+    user = User(name="Test User", phone_number="1234567890")
+    db.session.add(user)
+    db.session.commit()
+    user_id = user.id
+    test_client.put(f"/users/{user_id}/roles",
+                    json={"shop_id": shop_id, "role": "admin"})
+    assert test_client.delete(f"/users/{user_id}").status_code == 200
+
+    assert archive_deleted_users() == 1
+
+    response = test_client.get(f"/users/archived/{user_id}")
+    assert response.status_code == 200
+    assert [role["role"] for role in response.get_json()["roles"]] == [
+        "admin"]
+
+
+# Test turning sharding on for a database that already holds shops
+def test_register_existing_shops(tmp_path):
+    default_url = f"sqlite:///{tmp_path / 'default.db'}"
+    app = create_app(testing=True, config={
+                     'SQLALCHEMY_DATABASE_URI': default_url})
+    with app.app_context():
+        db.create_all()
+        category = Category(name="Test Category")
+        shops = [Shop(name=f"Old Shop {index}", latitude=10.0,
+                      longitude=10.0, phone_number="1234567890")
+                 for index in range(3)]
+        db.session.add_all([category, *shops])
+        db.session.commit()
+        db.session.add(Product(shop_id=shops[1].id, category_id=category.id,
+                               name="Old Product", amount=1, price=1.0))
+        db.session.commit()
+        db.session.remove()
+
+    shard_urls = [f"sqlite:///{tmp_path / f'shard{index}.db'}"
+                  for index in range(2)]
+    app = create_app(testing=True, config={
+        'SQLALCHEMY_DATABASE_URI': default_url,
+        'SHARD_DATABASE_URLS': shard_urls,
+        'SHARD_MOVE_DRAIN': 0,
+    })
+    with app.app_context():
+        db.create_all()
+        sharding.create_all()
+        assert sharding.register_existing_shops() == 3
+        assert sharding.register_existing_shops() == 0
+        assert sharding.shard_for(1) == DEFAULT_SHARD
+        test_client = app.test_client()
+
+        # Old shops are still served, and new ones get fresh ids
+        response = test_client.get("/shops/")
+        assert [shop["name"] for shop in response.get_json()] == [
+            "Old Shop 0", "Old Shop 1", "Old Shop 2"]
+        new_shop_id = create_shops(test_client, 1)[0]
+        assert new_shop_id == 4
+        assert test_client.get("/shops/1").get_json()["name"] == "Old Shop 0"
+
+        # New children do not reuse the ids of old ones
+        response = test_client.post(f"/shops/{new_shop_id}/products", json={
+            "category_id": 1, "name": "New Product", "amount": 1,
+            "price": 1.0})
+        assert response.get_json()["id"] > 1
+
+        # Old shops can be moved onto a shard
+        sharding.move_shop(2, "shard0")
+        assert sharding.shard_for(2) == "shard0"
+        assert count_on_shard(Shop, DEFAULT_SHARD) == 2
+        response = test_client.get("/shops/2/products")
+        assert response.get_json()[0]["name"] == "Old Product"
+        db.session.remove()
+
+
+# Test that shop lookups merge the ranked rows of every shard
+def test_lookup_shops_on_shards(test_client):
+    create_shops(test_client, 6)
+
+    response = test_client.get("/shops/lookup?name_prefix=test&per_page=4")
+    result = response.get_json()
+    assert [shop["name"] for shop in result["items"]] == [
+        f"Test Shop {index}" for index in range(4)]
+    assert result["has_more"] is True
+
+    response = test_client.get(
+        "/shops/lookup?name_prefix=test&per_page=4&page=2")
+    result = response.get_json()
+    assert [shop["name"] for shop in result["items"]] == [
+        "Test Shop 4", "Test Shop 5"]
+    assert result["has_more"] is False
@@ -1,6 +1,11 @@
 import pytest
+import sqlalchemy as sa
 from app import create_app, db
-from app.models import Shop, ShopHours, Product, Category
+from app.models import (Shop, ShopHours, Product, Category, ShopArchive,
+                        ProductArchive)
+from app.archive import archive_deleted_shops
+from app.migrations import add_archive_indexes
+from app.routes.versioning import commit_or_conflict
 
 
 @pytest.fixture
@@ -216,3 +221,183 @@ def test_list_products(test_client):
     db.session.delete(category)
     db.session.delete(shop)
     db.session.commit()
+
+
+# Test archive_deleted_shops
+def test_archive_deleted_shops(test_client):
+    live_shop = Shop(name="Live Shop", latitude=10.0,
+                     longitude=10.0, phone_number="1234567890")
+    deleted_shop = Shop(name="Deleted Shop", latitude=20.0,
+                        longitude=20.0, phone_number="0987654321",
+                        is_deleted=True)
+    category = Category(name="Test Category")
+    db.session.add_all([live_shop, deleted_shop, category])
+    db.session.commit()
+
+    product = Product(shop_id=deleted_shop.id, category_id=category.id,
+                      name="Test Product", amount=100, price=9.99)
+    shop_hours = ShopHours(shop_id=deleted_shop.id, day_of_week=1,
+                           open_time="9:00", close_time="18:00")
+    db.session.add_all([product, shop_hours])
+    db.session.commit()
+    live_shop_id, deleted_shop_id = live_shop.id, deleted_shop.id
+
+    assert archive_deleted_shops(batch_size=1) == 1
+
+    assert Shop.query.get(deleted_shop_id) is None
+    assert Shop.query.get(live_shop_id) is not None
+    assert Product.query.count() == 0
+    assert ShopHours.query.count() == 0
+    assert ShopArchive.query.get(deleted_shop_id).name == "Deleted Shop"
+
+    response = test_client.get(f"/shops/archived/{deleted_shop_id}")
+    json_data = response.get_json()
+
+    assert response.status_code == 200
+    assert json_data["name"] == "Deleted Shop"
+    assert json_data["products"][0]["name"] == "Test Product"
+    assert json_data["hours"][0]["day_of_week"] == 1
+
+    response = test_client.get(f"/shops/archived/{live_shop_id}")
+    assert response.status_code == 404
+
+
+# Test that children are archived in batches through the shop_id index
+def test_archive_children_in_batches(test_client):
+    shop = Shop(name="Deleted Shop", latitude=20.0, longitude=20.0,
+                phone_number="0987654321", is_deleted=True)
+    category = Category(name="Test Category")
+    db.session.add_all([shop, category])
+    db.session.commit()
+    db.session.add_all([Product(shop_id=shop.id, category_id=category.id,
+                                name=f"Product {index}", amount=1, price=1.0)
+                        for index in range(5)])
+    db.session.commit()
+
+    plan = db.session.execute(sa.text(
+        "EXPLAIN QUERY PLAN SELECT id FROM product WHERE shop_id IN (1, 2)"
+    )).all()
+    assert "ix_product_shop_id" in plan[0][-1]
+
+    commits = []
+    sa.event.listen(db.engine, "commit", commits.append)
+    assert archive_deleted_shops(batch_size=2) == 1
+    assert Product.query.count() == 0
+    assert ProductArchive.query.count() == 5
+    # Three batches of products, then the shop itself
+    assert len(commits) == 4
+
+
+# Test that the migration creates the archive indexes on existing tables
+def test_add_archive_indexes(test_client):
+    db.session.execute(sa.text("DROP INDEX ix_product_shop_id"))
+    db.session.execute(sa.text("DROP INDEX ix_shop_live"))
+    db.session.commit()
+
+    add_archive_indexes()
+    inspector = sa.inspect(db.engine)
+    assert "ix_product_shop_id" in [
+        index["name"] for index in inspector.get_indexes("product")]
+    assert "ix_shop_live" in [
+        index["name"] for index in inspector.get_indexes("shop")]
+
+
+# Test patch_shop
+def test_patch_shop(test_client):
+    shop = Shop(name="Test Shop", latitude=10.0,
+                longitude=10.0, phone_number="1234567890")
+    db.session.add(shop)
+    db.session.commit()
+
+    response = test_client.patch(f"/shops/{shop.id}",
+                                 json={"name": "Patched Shop"},
+                                 headers={"If-Match": '"1"'})
+    json_data = response.get_json()
+
+    assert response.status_code == 200
+    assert json_data["name"] == "Patched Shop"
+    assert json_data["phone_number"] == "1234567890"
+    assert json_data["version"] == 2
+    assert response.headers["ETag"] == 'W/"2"'
+
+    # A stale version is rejected
+    response = test_client.patch(f"/shops/{shop.id}",
+                                 json={"name": "Stale Shop"},
+                                 headers={"If-Match": '"1"'})
+    assert response.status_code == 412
+    assert Shop.query.get(shop.id).name == "Patched Shop"
+
+    # Unknown fields are rejected
+    response = test_client.patch(f"/shops/{shop.id}",
+                                 json={"is_deleted": True})
+    assert response.status_code == 400
+
+
+# Test that a concurrent write between load and commit is detected
+def test_update_shop_concurrent_write(test_client):
+    shop = Shop(name="Test Shop", latitude=10.0,
+                longitude=10.0, phone_number="1234567890")
+    db.session.add(shop)
+    db.session.commit()
+
+    db.session.execute(sa.update(Shop.__table__).where(
+        Shop.__table__.c.id == shop.id).values(version=5))
+    shop.name = "Lost Update"
+
+    with test_client.application.test_request_context():
+        response, status_code = commit_or_conflict()
+    assert status_code == 412
+
+
+# Test patch_product
+def test_patch_product(test_client):
+    shop = Shop(name="Test Shop", latitude=10.0,
+                longitude=10.0, phone_number="1234567890")
+    category = Category(name="Test Category")
+    db.session.add_all([shop, category])
+    db.session.commit()
+
+    product = Product(shop_id=shop.id, category_id=category.id,
+                      name="Test Product", amount=100, price=9.99)
+    db.session.add(product)
+    db.session.commit()
+
+    response = test_client.patch(
+        f"/shops/{shop.id}/products/{product.id}", json={"amount": 50})
+    json_data = response.get_json()
+
+    assert response.status_code == 200
+    assert json_data["amount"] == 50
+    assert json_data["name"] == "Test Product"
+    assert json_data["version"] == 2
+
+    # The product must belong to the shop in the URL
+    other_shop = Shop(name="Other Shop", latitude=10.0,
+                      longitude=10.0, phone_number="1234567890")
+    db.session.add(other_shop)
+    db.session.commit()
+    response = test_client.patch(
+        f"/shops/{other_shop.id}/products/{product.id}", json={"amount": 1})
+    assert response.status_code == 404
+    assert Product.query.get(product.id).amount == 50
+
+
+# Test lookup_shops
+def test_lookup_shops(test_client):
+    shop = Shop(name="Corner Shop", latitude=10.0,
+                longitude=10.0, phone_number="555 123 4567")
+    other_shop = Shop(name="Other Shop", latitude=10.0,
+                      longitude=10.0, phone_number="5559999999")
+    db.session.add_all([shop, other_shop])
+    db.session.commit()
+
+    response = test_client.get("/shops/lookup?phone=%2B1 555-123-4567")
+    json_data = response.get_json()
+
+    assert response.status_code == 200
+    assert [item["name"] for item in json_data["items"]] == ["Corner Shop"]
+
+    response = test_client.get("/shops/lookup?name_prefix=CORN")
+    json_data = response.get_json()
+
+    assert [item["name"] for item in json_data["items"]] == ["Corner Shop"]
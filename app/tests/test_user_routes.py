@@ -1,6 +1,10 @@
 import pytest
 from app import create_app, db
-from app.models import User, UserRole, Shop
+from app.models import User, UserRole, Shop, UserArchive, UserRoleArchive
+from app.archive import archive_deleted_users
+from app.lookup import backfill_lookup_columns
+from app.migrations import add_version_columns
+from app.phone import normalize_phone
 
 # Define a fixture to create a test app and set the app context
 
@@ -147,3 +151,210 @@ def test_modify_user_role(test_client):
         user_id=user.id, shop_id=shop.id).first()
     assert user_role is not None
     assert user_role.role == "staff"
+
+
+def test_archive_deleted_users(test_client):
+    # Add a live user and a soft-deleted user with a role
+    user = User(name="Test User", phone_number="1234567890")
+    deleted_user = User(name="Deleted User",
+                        phone_number="2345678901", is_deleted=True)
+    shop = Shop(name="Test Shop", latitude=0.0,
+                longitude=0.0, phone_number="0987654321")
+    db.session.add_all([user, deleted_user, shop])
+    db.session.commit()
+    db.session.add(UserRole(user_id=deleted_user.id,
+                   shop_id=shop.id, role="admin"))
+    db.session.commit()
+    deleted_user_id = deleted_user.id
+
+    # Move the soft-deleted user out of the hot tables
+    assert archive_deleted_users() == 1
+    assert User.query.get(deleted_user_id) is None
+    assert UserRole.query.count() == 0
+    assert UserArchive.query.count() == 1
+    assert UserRoleArchive.query.count() == 1
+
+    # The archived user is still retrievable through the archive endpoint
+    response = test_client.get(f'/users/archived/{deleted_user_id}')
+    assert response.status_code == 200
+    archived_user = response.get_json()
+    assert archived_user['name'] == "Deleted User"
+    assert archived_user['roles'][0]['role'] == "admin"
+
+
+def test_patch_user(test_client):
+    # Add a test user to the database
+    user = User(name="Test User", phone_number="1234567890")
+    db.session.add(user)
+    db.session.commit()
+
+    # Fetch the user to learn its current version
+    response = test_client.get(f'/users/{user.id}')
+    etag = response.headers['ETag']
+
+    # Send only the changed field with the version we read
+    response = test_client.patch(f'/users/{user.id}',
+                                 json={"phone_number": "0987654321"},
+                                 headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json()['name'] == "Test User"
+    assert response.get_json()['phone_number'] == "0987654321"
+
+    # Writing again with the old version is a conflict
+    response = test_client.put(f'/users/{user.id}',
+                               json={"name": "Other", "phone_number": "1"},
+                               headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert User.query.get(user.id).name == "Test User"
+
+
+def test_normalize_phone():
+    # Formatting is dropped and the default country code added
+    assert normalize_phone("(555) 123-4567", "1") == "+15551234567"
+    assert normalize_phone("011 2345 6789", "55") == "+551123456789"
+    # International prefixes are kept
+    assert normalize_phone("+44 20 7946 0958", "1") == "+442079460958"
+    assert normalize_phone("0044 20 7946 0958", "1") == "+442079460958"
+
+
+def test_create_user_numeric_phone(test_client):
+    # Phone numbers sent as JSON numbers are accepted and normalized
+    response = test_client.post('/users/', json={"name": "New User",
+                                                 "phone_number": 5551234567})
+    assert response.status_code == 201
+    user = User.query.get(response.get_json()['id'])
+    assert user.phone_normalized == "+15551234567"
+
+    # Null values are rejected instead of failing the insert
+    response = test_client.post('/users/', json={"name": None,
+                                                 "phone_number": "1"})
+    assert response.status_code == 400
+    response = test_client.patch(f'/users/{user.id}', json={"name": None})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "Field cannot be null: name"
+
+
+def test_lookup_users_by_phone(test_client):
+    # Add users with differently formatted numbers
+    user1 = User(name="Test User 1", phone_number="555-123-4567")
+    user2 = User(name="Test User 2", phone_number="+1 (555) 123 4567")
+    user3 = User(name="Test User 3", phone_number="5559999999")
+    deleted_user = User(name="Deleted User",
+                        phone_number="5551234567", is_deleted=True)
+    db.session.add_all([user1, user2, user3, deleted_user])
+    db.session.commit()
+
+    # Send a GET request with yet another formatting
+    response = test_client.get('/users/lookup?phone=(555) 123-4567')
+    assert response.status_code == 200
+
+    # Both live users with that number are returned, deleted ones are not
+    result = response.get_json()
+    assert [user['name'] for user in result['items']] == [
+        "Test User 1", "Test User 2"]
+    assert result['has_more'] is False
+
+
+def test_lookup_users_by_name_prefix(test_client):
+    # Add users sharing a name prefix
+    names = ["Anna Smith", "Ann", "anne", "Annabel", "Bob"]
+    db.session.add_all([User(name=name, phone_number="1234567890")
+                        for name in names])
+    db.session.commit()
+
+    # The exact match ranks first, then shorter names
+    response = test_client.get('/users/lookup?name_prefix=ann&per_page=2')
+    result = response.get_json()
+    assert [user['name'] for user in result['items']] == ["Ann", "anne"]
+    assert result['has_more'] is True
+
+    response = test_client.get(
+        '/users/lookup?name_prefix=ann&per_page=2&page=2')
+    result = response.get_json()
+    assert [user['name'] for user in result['items']] == [
+        "Annabel", "Anna Smith"]
+    assert result['has_more'] is False
+
+    # Exactly one search is required
+    response = test_client.get('/users/lookup')
+    assert response.status_code == 400
+
+    # LIKE wildcards in the prefix match literally
+    response = test_client.get('/users/lookup?name_prefix=a%25')
+    assert response.get_json()['items'] == []
+
+    # Paging is limited to the first results
+    response = test_client.get(
+        '/users/lookup?name_prefix=ann&page=100000000&per_page=100')
+    assert response.status_code == 400
+
+    # A phone without digits does not match every number
+    response = test_client.get('/users/lookup?phone=abc')
+    assert response.status_code == 400
+
+
+def test_backfill_lookup_columns(test_client):
+    # Add a user, then clear its lookup columns as in a pre-migration row
+    user = User(name="Test User", phone_number="555-123-4567")
+    db.session.add(user)
+    db.session.commit()
+    db.session.execute(User.__table__.update().values(
+        phone_normalized=None, name_search=None))
+    db.session.commit()
+
+    # The backfill fills them without bumping the row version
+    assert backfill_lookup_columns() == (0, 1)
+    db.session.expire_all()
+    user = User.query.get(user.id)
+    assert user.phone_normalized == "+15551234567"
+    assert user.name_search == "test user"
+    assert user.version == 1
+
+
+def test_archive_deleted_users_twice(test_client):
+    # Archive a user, then create and archive another one
+    for name in ["Deleted User 1", "Deleted User 2"]:
+        user = User(name=name, phone_number="1234567890")
+        db.session.add(user)
+        db.session.commit()
+        assert test_client.delete(f'/users/{user.id}').status_code == 200
+        assert archive_deleted_users() == 1
+
+    # The second user got a fresh id instead of the archived one
+    assert [user.name for user in UserArchive.query.order_by(
+        UserArchive.id)] == ["Deleted User 1", "Deleted User 2"]
+
+
+def test_add_version_columns(test_client):
+    # Drop the version column, as in a table created before it existed
+    db.session.execute(db.text('ALTER TABLE user DROP COLUMN version'))
+    db.session.execute(db.text(
+        "INSERT INTO user (name, phone_number, is_deleted) "
+        "VALUES ('Old User', '1234567890', 0)"))
+    db.session.commit()
+
+    # The migration adds it back with existing rows at version 1
+    add_version_columns()
+    user = User.query.filter_by(name="Old User").one()
+    assert user.version == 1
+    response = test_client.patch(f'/users/{user.id}', json={"name": "New"},
+                                 headers={"If-Match": '"1"'})
+    assert response.status_code == 200
+    assert response.get_json()['version'] == 2
+
+
+def test_backfill_lookup_columns_archive(test_client):
+    # Drop the lookup columns from the archive, as before the migration
+    for name in ['phone_normalized', 'name_search']:
+        db.session.execute(db.text(
+            f'ALTER TABLE user_archive DROP COLUMN {name}'))
+    db.session.commit()
+
+    # After the migration, archival can copy every column again
+    backfill_lookup_columns()
+    user = User(name="Deleted User", phone_number="1234567890",
+                is_deleted=True)
+    db.session.add(user)
+    db.session.commit()
+    assert archive_deleted_users() == 1
+    assert UserArchive.query.one().name == "Deleted User"
@@ -0,0 +1,27 @@
+import glob
+import os
+
+# Load and warm up the app once in the master, see app.preload
+preload_app = True
+
+
+# Remove metric files left behind by the workers of a previous run, so
+# counters start from zero like a regular process restart, and reset the
+# shared admission state along with its in-flight counts
+def on_starting(server):
+    from app.admission import DEFAULT_ADMISSION_DIR
+    from app.metrics import DEFAULT_METRICS_DIR
+
+    directory = os.environ.get('METRICS_DIR') or DEFAULT_METRICS_DIR
+    for path in glob.glob(os.path.join(directory, 'metrics_*.db')):
+        os.remove(path)
+
+    state_file = os.path.join(DEFAULT_ADMISSION_DIR, 'admission.db')
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+
+# Give each worker its own database connections
+def post_fork(server, worker):
+    from app import preload
+    preload.post_fork(server.app.wsgi())